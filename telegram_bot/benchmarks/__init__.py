@@ -0,0 +1,22 @@
+import os
+
+
+# Обязательные настройки бота (src.config) для запуска без .env - задаются до импорта src
+BOT_ENV_DEFAULTS = {
+    "ENVIRONMENT": "dev",
+    "TELEGRAM_BOT_TOKEN_DEV": "123456:LOADTEST",
+    "YOOKASSA_PAYMENT_TOKEN_TEST": "loadtest",
+    "OPENAI_API_KEY_DEV": "loadtest",
+    "MAX_TOKENS_DEV": "1000",
+    "TRIAL_PERIOD_NUM_REQ": "1000000",
+    "SUBSCRIPTION_DURATION_MONTHS": "1",
+    "SUBSCRIPTION_PRICE_RUB": "100",
+    "EMAIL_FOR_BILL": "loadtest@example.com",
+    "MAX_HISTORY_LENGTH_TRIAL": "1000",
+    "MAX_HISTORY_LENGTH_PAID": "1000",
+    "OPENAI_RPM_LIMIT": "1000000",
+    "OPENAI_TPM_LIMIT": "1000000000",
+}
+
+for name, value in BOT_ENV_DEFAULTS.items():
+    os.environ.setdefault(name, value)
@@ -0,0 +1,335 @@
+"""
+Микробенчмарки горячих путей: разбиение текста, конвертация в MarkdownV2,
+кодирование истории, накладные расходы цепочки middleware (с заглушками вместо Redis/Postgres).
+
+Запуск из каталога telegram_bot:
+    python -m benchmarks.micro                                   # вывести результаты
+    python -m benchmarks.micro --save benchmarks/baseline.json   # сохранить базовую линию
+    python -m benchmarks.micro --compare benchmarks/baseline.json --tolerance 0.25
+
+В режиме --compare код выхода 1, если какой-либо случай медленнее базовой линии больше, чем на tolerance.
+Базовая линия зависит от машины - сохраняйте ее на той же машине, где выполняется сравнение.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable
+
+from aiogram import Bot, Dispatcher, Router, F
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import TelegramMethod
+from aiogram.types import Message, Update
+
+from src.aiogram.utils import split_message
+from src.aiogram.utils.render import _telegramify
+from src.aiogram.handlers import messages
+from src.database import UserState
+from src.database.history_codec import encode_history_entry, decode_history_entry
+from src.logger import logger
+
+
+MIN_TIME = 0.2  # Минимальная длительность одного замера, с
+REPEAT = 5
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Данные
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+LLM_MARKDOWN = r"""
+## Сортировка списка словарей
+
+Для сортировки используйте `sorted` с параметром **key**:
+
+```python
+users = [{"name": "Анна", "age": 31}, {"name": "Борис", "age": 25}]
+by_age = sorted(users, key=lambda user: user["age"])
+print(by_age)
+```
+
+| Способ | Сложность | Стабильность |
+|--------|-----------|--------------|
+| `sorted` | O(n log n) | да |
+| `list.sort` | O(n log n) | да |
+| `heapq.nsmallest` | O(n log k) | нет |
+
+Формула среднего: $\bar{x} = \frac{1}{n}\sum_{i=1}^{n} x_i$, а дисперсия
+
+$$\sigma^2 = \frac{1}{n}\sum_{i=1}^{n}(x_i - \bar{x})^2$$
+
+1. Первый пункт с *курсивом*
+2. Второй пункт со [ссылкой](https://docs.python.org/3/howto/sorting.html)
+   - вложенный пункт
+   - ещё один
+
+> Цитата: "Простое лучше, чем сложное."
+"""
+
+
+def text_of_size(size: int) -> str:
+    """Текст, похожий на ответ модели: абзацы, строки и длинные слова"""
+    rng = random.Random(size)
+    words = ["слово", "ответ", "Python", "функция", "данные", "пример", "значение", "x" * 40]
+    parts, length = [], 0
+    while length < size:
+        line = " ".join(rng.choice(words) for _ in range(rng.randint(5, 25)))
+        parts.append(line)
+        length += len(line) + 1
+        if rng.random() < 0.2:
+            parts.append("")
+            length += 1
+    return "\n".join(parts)[:size]
+
+
+def history_of_size(entries: int) -> list[dict]:
+    history = []
+    for i in range(entries):
+        role = "user" if i % 2 == 0 else "assistant"
+        content = text_of_size(200 if role == "user" else 1500)
+        history.append({'role': role, 'content': content})
+    return history
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Заглушки для цепочки middleware
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+class StubSession(BaseSession):
+    """Bot API без сети: send*/edit* возвращают сообщение, остальное - True"""
+    def __init__(self):
+        super().__init__()
+        self.message_id = 0
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: int | None = None) -> Any:
+        if method.__returning__ is Message:
+            self.message_id += 1
+            return Message.model_validate({
+                "message_id": self.message_id,
+                "date": int(time.time()),
+                "chat": {"id": getattr(method, "chat_id", 0), "type": "private"},
+                "text": getattr(method, "text", None),
+            })
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+class StubDatabase:
+    async def add_user(self, **kwargs):
+        pass
+
+
+class StubEntitlements:
+    async def get(self, user_id):
+        return UserState(telegram_id=user_id)
+
+    async def set(self, user_state):
+        pass
+
+    async def add_requests(self, user_id, amount: int = 1):
+        pass
+
+
+class StubUsage:
+    async def record(self, telegram_id, **kwargs):
+        return None
+
+
+class StubRedis:
+    async def acquire_lease(self, user_id, ttl_ms):
+        return 1
+
+    async def keep_lease(self, user_id, token, ttl_ms):
+        await asyncio.Event().wait()
+
+    async def release_lease(self, user_id, token):
+        return True
+
+    async def get_history_length(self, user_id):
+        return 0
+
+    async def clear_user_history(self, user_id):
+        pass
+
+
+class StubDeletionScheduler:
+    async def schedule(self, chat_id, message_id, **kwargs):
+        pass
+
+    def delete_now(self, chat_id, message_id):
+        pass
+
+
+def create_dispatcher(with_middlewares: bool) -> Dispatcher:
+    router = Router()
+    if with_middlewares:
+        # Та же цепочка, что у messages.router (без хендлера с запросом к OpenAI)
+        for middleware in messages.router.message.middleware:
+            router.message.middleware(middleware)
+
+    @router.message(F.text)
+    async def handler(message: Message):
+        pass
+
+    dp = Dispatcher(
+        db=StubDatabase(),
+        redis=StubRedis(),
+        entitlements=StubEntitlements(),
+        usage=StubUsage(),
+        deletion_scheduler=StubDeletionScheduler(),
+    )
+    dp.include_router(router)
+    return dp
+
+
+def text_update(update_id: int) -> Update:
+    return Update.model_validate({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": 1, "type": "private"},
+            "from": {"id": 1, "is_bot": False, "first_name": "Bench"},
+            "text": "Привет",
+        },
+    })
+
+
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+# Случаи
+# - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+def cases() -> dict[str, Callable[[], Callable[[], Awaitable[Any] | Any]]]:
+    """Имя -> фабрика функции одной операции (подготовка данных не входит в замер)"""
+    result = {}
+
+    # Не меньше лимита сообщения (4096) - иначе разбиения нет
+    for label, size in (("5KB", 5 * 1024), ("64KB", 64 * 1024), ("1MB", 1024 * 1024)):
+        def split_case(size=size):
+            text = text_of_size(size)
+            return lambda: split_message(text, with_photo=False)
+        result[f"split_message/{label}"] = split_case
+
+    for label, repeat in (("1x", 1), ("8x", 8)):
+        def render_case(repeat=repeat):
+            md = LLM_MARKDOWN * repeat
+            return lambda: _telegramify(md)
+        result[f"render/llm_markdown_{label}"] = render_case
+
+    for entries in (10, 100, 500):
+        def encode_case(entries=entries):
+            history = history_of_size(entries)
+            return lambda: [encode_history_entry(message) for message in history]
+
+        def decode_case(entries=entries):
+            encoded = [encode_history_entry(message) for message in history_of_size(entries)]
+            return lambda: [decode_history_entry(entry) for entry in encoded]
+
+        def decode_json_case(entries=entries):
+            encoded = [json.dumps(message) for message in history_of_size(entries)]
+            return lambda: [decode_history_entry(entry) for entry in encoded]
+
+        result[f"history/encode/{entries}"] = encode_case
+        result[f"history/decode/{entries}"] = decode_case
+        result[f"history/decode_legacy_json/{entries}"] = decode_json_case
+
+    for label, with_middlewares in (("bare", False), ("messages_chain", True)):
+        def middleware_case(with_middlewares=with_middlewares):
+            dp = create_dispatcher(with_middlewares)
+            bot = Bot(token="123456:BENCH", session=StubSession())
+            update_ids = iter(range(1, 10**9))
+            return lambda: dp.feed_update(bot, text_update(next(update_ids)))
+        result[f"middleware/{label}"] = middleware_case
+
+    return result
+
+
+async def measure(operation: Callable[[], Awaitable[Any] | Any]) -> dict:
+    """Время одной операции: лучший и медианный из REPEAT замеров (каждый не короче MIN_TIME)"""
+    async def run(number: int) -> float:
+        start = time.perf_counter()
+        for _ in range(number):
+            result = operation()
+            if asyncio.iscoroutine(result):
+                await result
+        return time.perf_counter() - start
+
+    # Подбираем количество повторов
+    number = 1
+    while (elapsed := await run(number)) < MIN_TIME:
+        number = max(number * 2, int(number * MIN_TIME / max(elapsed, 1e-9)) + 1)
+
+    timings = [await run(number) / number for _ in range(REPEAT)]
+    return {"best_us": min(timings) * 1e6, "median_us": statistics.median(timings) * 1e6, "number": number}
+
+
+async def run_cases(selected: list[str] | None) -> dict:
+    results = {}
+    for name, factory in cases().items():
+        if selected and not any(pattern in name for pattern in selected):
+            continue
+        results[name] = await measure(factory())
+        print(f"{name:<40}{results[name]['best_us']:>14.1f} us{results[name]['median_us']:>14.1f} us")
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> bool:
+    """Сравнение с базовой линией по лучшему времени. True - регрессий нет"""
+    ok = True
+    print(f"\n{'':<40}{'baseline':>14}{'current':>14}{'change':>10}")
+    for name, current in results.items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print(f"{name:<40}{'-':>14}{current['best_us']:>12.1f}us{'new':>10}")
+            continue
+        change = current["best_us"] / base["best_us"] - 1
+        mark = ""
+        if change > tolerance:
+            mark = "  REGRESSION"
+            ok = False
+        print(f"{name:<40}{base['best_us']:>12.1f}us{current['best_us']:>12.1f}us{change:>+10.1%}{mark}")
+    return ok
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Микробенчмарки горячих путей бота")
+    parser.add_argument("cases", nargs="*", help="Подстроки имен случаев (по умолчанию - все)")
+    parser.add_argument("--save", help="Сохранить результаты как базовую линию (JSON)")
+    parser.add_argument("--compare", help="Сравнить с базовой линией (JSON)")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Допустимое замедление (0.2 = 20%%)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # Логи middleware (DEBUG на каждый апдейт) искажают замеры
+    logger.setLevel(logging.WARNING)
+    print(f"{'case':<40}{'best':>17}{'median':>17}")
+    results = asyncio.run(run_cases(args.cases))
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as file:
+            json.dump({
+                "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "results": results,
+            }, file, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            baseline = json.load(file)
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
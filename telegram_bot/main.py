@@ -1,15 +1,26 @@
-from src.config import TELEGRAM_BOT_TOKEN, POSTRGRES_URL, REDIS_PORT, REDIS_HOST
-from src.database import Database, Redis
+from src.config import TELEGRAM_BOT_TOKEN, POSTRGRES_URL, REDIS_PORT, REDIS_HOST, BOT_MODE, METRICS_PORT
+from src.database import Database, Redis, EntitlementCache, UsageAggregator
 from src.gpt import OpenAI_API
+from src.history_compaction import HistoryCompactor
+from src.response_cache import ResponseCache
 from src.logger import logger
 from src.aiogram.middlewares.middlewares import (
     ErrorLoggingMiddleware, # Deprecated
     DatabaseMiddleware, 
     OpenAIMiddleware, 
-    RedisMiddleware 
+    RedisMiddleware,
+    EntitlementMiddleware,
+    UsageMiddleware,
+    DeletionSchedulerMiddleware,
+    HistoryCompactorMiddleware,
+    DeliveryMiddleware,
+    ResponseCacheMiddleware,
+    TracingMiddleware
     )
 from src.aiogram.handlers.system import on_startup, on_shutdown, init_error_handler
 from src.aiogram.handlers import messages, commands, errors, payment
+from src.aiogram.utils import DeletionScheduler, DeliveryService
+from src.aiogram.webhook import run_webhook
 
 from aiogram.methods import DeleteWebhook
 from aiogram import Bot, Dispatcher
@@ -19,19 +30,32 @@ from functools import partial
 
 from prometheus_client import start_http_server
 
-@init_error_handler
-async def main() -> None:
-    # db = Database("./database.db") # sqlite3
-    db = Database(POSTRGRES_URL) # PostgreSQL
+async def create_dispatcher(bot: Bot, db: Database, redis: Redis) -> Dispatcher:
+    """Создание компонентов бота и диспетчера (используется также в benchmarks/loadtest.py)"""
     db_middleware = DatabaseMiddleware(db)
+    redis_middleware = RedisMiddleware(redis)
 
     openai = await OpenAI_API.create()
     openai_middleware = OpenAIMiddleware(openai)
 
-    redis = await Redis.create(REDIS_HOST, REDIS_PORT)
-    redis_middleware = RedisMiddleware(redis)
+    usage = await UsageAggregator.create(db)
+    usage_middleware = UsageMiddleware(usage)
+
+    entitlements = await EntitlementCache.create(db, redis, usage)
+    entitlement_middleware = EntitlementMiddleware(entitlements)
+
+    compactor = HistoryCompactor(redis, openai, usage)
+    compactor_middleware = HistoryCompactorMiddleware(compactor)
+
+    response_cache = ResponseCache(redis)
+    response_cache_middleware = ResponseCacheMiddleware(response_cache)
+
+    deletion_scheduler = await DeletionScheduler.create(bot, redis)
+    deletion_scheduler_middleware = DeletionSchedulerMiddleware(deletion_scheduler)
+
+    delivery = DeliveryService()
+    delivery_middleware = DeliveryMiddleware(delivery)
 
-    bot = Bot(token=TELEGRAM_BOT_TOKEN)
     dp = Dispatcher()
     dp.include_routers(
         payment.router,
@@ -42,21 +66,44 @@ async def main() -> None:
     
     # Регистрация lifecycle-событий
     dp.startup.register(partial(on_startup, db))
-    dp.shutdown.register(partial(on_shutdown, db, redis))
+    dp.shutdown.register(partial(on_shutdown, db, redis, entitlements, usage, deletion_scheduler, compactor, delivery))
 
     # dp.update.middleware(ErrorLoggingMiddleware(
     #     bot=bot,
     #     db=db,
     #     redis=redis
     # ))
+    dp.update.outer_middleware(TracingMiddleware())
     dp.update.middleware(db_middleware)
     dp.update.middleware(redis_middleware)
     dp.update.middleware(openai_middleware)
+    dp.update.middleware(entitlement_middleware)
+    dp.update.middleware(usage_middleware)
+    dp.update.middleware(deletion_scheduler_middleware)
+    dp.update.middleware(compactor_middleware)
+    dp.update.middleware(delivery_middleware)
+    dp.update.middleware(response_cache_middleware)
 
     dp.errors.middleware(redis_middleware)
     dp.errors.middleware(db_middleware)
+
+    return dp
+
+
+@init_error_handler
+async def main() -> None:
+    # db = Database("./database.db") # sqlite3
+    db = Database(POSTRGRES_URL) # PostgreSQL
+    redis = await Redis.create(REDIS_HOST, REDIS_PORT)
+    bot = Bot(token=TELEGRAM_BOT_TOKEN)
+
+    dp = await create_dispatcher(bot, db, redis)
     
-    
+    if BOT_MODE == "webhook":
+        logger.info("(MAIN)\t\t Bot has started successfully (webhook)")
+        await run_webhook(dp, bot)
+        return
+
     await bot(DeleteWebhook(drop_pending_updates=True))
 
     logger.info("(MAIN)\t\t Bot has started successfully")
@@ -68,7 +115,9 @@ async def main() -> None:
 if __name__ == "__main__":
     
     # Start up the server to expose the metrics.
-    start_http_server(8000)
+    # В режиме webhook /metrics отдается сервером webhook
+    if BOT_MODE != "webhook":
+        start_http_server(METRICS_PORT)
 
     asyncio.run(main())
         
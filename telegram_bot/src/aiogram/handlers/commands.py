@@ -5,16 +5,18 @@ from aiogram.enums import ParseMode
 
 from src.logger import logger
 
-from src.database import Redis, Database
-from src.aiogram.middlewares.middlewares import WaitingMiddleware, CheckNewUserMiddleware
+from src.database import Redis, Database, UserState
+from src.aiogram.middlewares.middlewares import WaitingMiddleware, UserStateMiddleware, CheckNewUserMiddleware
 from src.config import TRIAL_PERIOD_NUM_REQ
-from src.aiogram.utils import commands_text, answer_message
+from src.aiogram.utils import commands_text, answer_message, DeliveryService
 
 from datetime import datetime
+import pytz
 
 
 router = Router()
 
+router.message.middleware(UserStateMiddleware())
 router.message.middleware(CheckNewUserMiddleware())
 router.message.middleware(WaitingMiddleware())
 
@@ -26,12 +28,11 @@ async def start_handler(message: Message) -> None:
 @router.message(Command('reset_conversation'))
 async def reset_handler(message: Message, redis: Redis):
     await redis.clear_user_history(message.from_user.id)
-    await redis.set_user_req_inactive(message.from_user.id)
     await message.answer("Диалог сброшен")
 
 
 @router.message(Command('show_dialog'))
-async def reset_handler(message: Message, redis: Redis):
+async def reset_handler(message: Message, redis: Redis, delivery: DeliveryService):
     history = await redis.get_history(message.from_user.id)
     if not history:
         await message.answer("Диалог пуст")
@@ -42,12 +43,15 @@ async def reset_handler(message: Message, redis: Redis):
             sender = "Пользователь"
         elif cur_message["role"] == "assistant":
             sender = "Бот"
+        elif cur_message["role"] == "system":
+            sender = "Краткое содержание"
         else:
             sender = "Неизвестно кто"
 
         await answer_message(
             md=f"*{sender}*:\n" + cur_message['content'],
             message=message,
+            delivery=delivery,
         )
 
 @router.message(Command('help'))
@@ -62,50 +66,18 @@ async def reset_handler(message: Message, redis: Redis):
     await message.answer(text, parse_mode=ParseMode.MARKDOWN_V2)
 
 @router.message(Command('profile'))
-async def profile_handler(message: Message, db: Database):
+async def profile_handler(message: Message, user_state: UserState):
     user_id: int = message.from_user.id
 
-    profile_text = (
-        "Профиль\n\n"
-        f"ID: {user_id}\n\n"
-    )
-
-    if await db.is_subscription_active(user_id):
-        sub_type = "Есть"
-        sub_expiration_date = await db.get_sub_expiration_date(
-            telegram_id=user_id, 
-            user_tz="Europe/Moscow"
-            )
-        profile_text += (
-            f"Подписка: {sub_type}\n"
-            f"Дата окончания\n"
-            f"{sub_expiration_date}\n\n"
-        )
-        
-    elif await db.is_user_trial(user_id):
-        req_remain = TRIAL_PERIOD_NUM_REQ - await db.get_num_requests(user_id)
-        profile_text += (
-            f"Подписка: Пробная\n"
-            f"Остаток: {req_remain} / {TRIAL_PERIOD_NUM_REQ}\n\n"
-        )
-    else:
-        profile_text += (
-            f"Подписка: Отсутствует\n"
-            f"Оплатите подписку, используя /pay\n\n"
-        )
-
-    
     profile_text = [f"📌 *Профиль*\n\nID: `{user_id}`\n"]
 
-    if await db.is_subscription_active(user_id):
-        sub_expiration_date = await db.get_sub_expiration_date(
-            telegram_id=user_id, user_tz="Europe/Moscow"
-        )
+    if user_state.is_subscription_active:
+        sub_expiration_date = user_state.sub_expiration_date.astimezone(pytz.timezone("Europe/Moscow"))
         formatted_date = datetime.strftime(sub_expiration_date, "%Y-%m-%d %H:%M:%S")
         profile_text.append(f"*Подписка:* Активна ✅\n*Окончание:*\n`{formatted_date} (МСК)`\n")
     
-    elif await db.is_user_trial(user_id):
-        req_remain = TRIAL_PERIOD_NUM_REQ - await db.get_num_requests(user_id)
+    elif user_state.is_trial:
+        req_remain = user_state.trial_requests_remain
         profile_text.append(f"*Подписка:* Пробная 🆓\n*Осталось:* `{req_remain}/{TRIAL_PERIOD_NUM_REQ}` запросов\n")
     
     else:
@@ -7,11 +7,15 @@ from src.database import Redis, Database
 import sys
 import traceback
 
+import openai
+
 from src.prometheus_metrics import ERRORS_COUNTER
 
 
 router = Router()
 
+TRANSIENT_OPENAI_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
 @router.error()
 async def global_error_handler(event: ErrorEvent, bot: Bot, redis: Redis, db: Database):
     """
@@ -52,9 +56,11 @@ async def global_error_handler(event: ErrorEvent, bot: Bot, redis: Redis, db: Da
         traceback=traceback.format_exc()
     )
 
-    # Удаляем историю сессии
-    await redis.clear_user_history(telegram_id)
-    await redis.set_user_req_inactive(telegram_id)
+    # Удаляем историю сессии (кроме временных ошибок OpenAI - история в порядке)
+    if not isinstance(exception, TRANSIENT_OPENAI_ERRORS):
+        await redis.clear_user_history(telegram_id)
+    # Аренду запроса не трогаем: WaitingMiddleware освобождает свою (по fencing-токену) до вызова
+    # этого обработчика, а безусловное удаление сняло бы аренду уже следующего запроса
 
     # Увеличиваем метрику ошибок
     ERRORS_COUNTER.labels(error_type=str(exception.__class__.__name__)).inc()
@@ -8,43 +8,62 @@ from aiogram.enums import ParseMode
 from src.logger import logger
 from src.aiogram.utils import split_message
 
-from src.database import Database
+from src.database import Database, UsageAggregator, UserState
 from src.aiogram.middlewares.middlewares import (
     WaitingMiddleware, 
+    UserStateMiddleware,
     CheckNewUserMiddleware,
     IncrementRequestsMiddleware,
     CheckSubscriptionMiddleware,
     CheckTrialPeriodMiddleware,
     TimingMessageMiddleware,
-    CheckHistoryLengthMiddleware
+    CheckHistoryLengthMiddleware,
+    TracedMiddleware
     )
 from src.gpt import OpenAI_API
 from src.database import Redis
+from src.history_compaction import HistoryCompactor
+from src.response_cache import ResponseCache
 
-from src.aiogram.utils import answer_message
+from src.aiogram.utils import answer_message, StreamingEditor, DeliveryService
+from src.tokens import count_message_tokens
+from src.config import HISTORY_TOKEN_BUDGET
+from src.prometheus_metrics import TOKENS_COUNTER
 
 
 router = Router()
 
+# Каждый middleware - отдельный интервал в трассе апдейта (TracedMiddleware)
+
 # Inner/Outer Middlwares
-router.message.middleware(TimingMessageMiddleware())
+router.message.middleware(TracedMiddleware(TimingMessageMiddleware()))
 
 # Inner Middlwares
-router.message.middleware(CheckNewUserMiddleware())
-router.message.middleware(CheckTrialPeriodMiddleware())
-router.message.middleware(CheckSubscriptionMiddleware())
+router.message.middleware(TracedMiddleware(UserStateMiddleware()))
+router.message.middleware(TracedMiddleware(CheckNewUserMiddleware()))
+router.message.middleware(TracedMiddleware(CheckTrialPeriodMiddleware()))
+router.message.middleware(TracedMiddleware(CheckSubscriptionMiddleware()))
 
 # Inner/Outer Middlwares
-router.message.middleware(WaitingMiddleware())
-router.message.middleware(CheckHistoryLengthMiddleware())
+router.message.middleware(TracedMiddleware(WaitingMiddleware()))
+router.message.middleware(TracedMiddleware(CheckHistoryLengthMiddleware()))
 
 # Outer Middlwares
-router.message.middleware(IncrementRequestsMiddleware())
+router.message.middleware(TracedMiddleware(IncrementRequestsMiddleware()))
 
 
 @router.message(F.text)
-async def message_handler(message: Message, db : Database, openai: OpenAI_API, redis: Redis) -> None:
-    history = await redis.get_history(message.from_user.id)
+async def message_handler(message: Message, 
+                          usage: UsageAggregator, 
+                          openai: OpenAI_API, 
+                          redis: Redis, 
+                          compactor: HistoryCompactor,
+                          delivery: DeliveryService,
+                          response_cache: ResponseCache | None = None,
+                          user_state: UserState | None = None,
+                          history_len: int | None = None,
+                          tech_message: Message | None = None,
+                          lease_token: int | None = None) -> None:
 
     ## TEST
     ## ----------------------------
@@ -55,25 +74,63 @@ async def message_handler(message: Message, db : Database, openai: OpenAI_API, r
     ## ----------------------------
 
     user_message = {'role': 'user', 'content': message.text}
-    assistant_reply, role, num_in_tokens, num_out_tokens = await openai.get_response(history, user_message)
+    user_message_tokens = count_message_tokens(user_message)
+    # Последние сообщения истории, которые помещаются в бюджет токенов вместе с новым сообщением.
+    # Длина истории уже известна из CheckHistoryLengthMiddleware - пустую историю не запрашиваем
+    history = []
+    if history_len != 0:
+        history = await redis.get_history_window(
+            message.from_user.id, 
+            token_budget=HISTORY_TOKEN_BUDGET - user_message_tokens
+        ) or []
+    tier = "paid" if user_state and user_state.is_subscription_active else "trial"
+
+    # Первый запрос диалога может быть в кэше ответов
+    cache_key, cached = None, None
+    if response_cache is not None and response_cache.enabled and history_len == 0:
+        cache_key = response_cache.key(openai.model_id, [user_message])
+        cached = await response_cache.get(cache_key)
+
+    if cached:
+        assistant_reply, role = cached['content'], cached['role']
+        num_in_tokens, num_out_tokens = cached['input_tokens'], cached['output_tokens']
+        # Токены ответа из кэша OpenAI не списывал - считаем их отдельно от тарифов
+        TOKENS_COUNTER.labels("input", "cached").inc(num_in_tokens or 0)
+        TOKENS_COUNTER.labels("output", "cached").inc(num_out_tokens or 0)
+    else:
+        # Потоковый ответ показываем в техническом сообщении
+        stream_editor = StreamingEditor(tech_message) if tech_message else None
+        assistant_reply, role, num_in_tokens, num_out_tokens = await openai.get_response(
+            history, user_message, 
+            on_delta=stream_editor,
+            user_id=message.from_user.id,
+            priority=tier == "paid",
+        )
+        if stream_editor:
+            await stream_editor.close()
+        TOKENS_COUNTER.labels("input", tier).inc(num_in_tokens or 0)
+        TOKENS_COUNTER.labels("output", tier).inc(num_out_tokens or 0)
+        if cache_key and assistant_reply:
+            await response_cache.set(cache_key, {
+                'role': role,
+                'content': assistant_reply,
+                'input_tokens': num_in_tokens or 0,
+                'output_tokens': num_out_tokens or 0,
+            })
     assistant_message = {'role': role, 'content': assistant_reply}
 
-    await redis.append_to_history(
+    history_len = await redis.append_to_history(
         user_id=message.from_user.id, 
-        messages=[user_message, assistant_message])
+        messages=[user_message, assistant_message],
+        token_counts=[user_message_tokens, count_message_tokens(assistant_message)],
+        lease_token=lease_token)
     
-    if num_in_tokens:
-        # Добавляем входные токены пользователю
-        await db.add_user_input_tokens(
-            telegram_id=message.from_user.id,
-            tokens=num_in_tokens
-        )
-    if num_out_tokens:
-        # Добавляем выходные токены пользователю
-        await db.add_user_output_tokens(
-            telegram_id=message.from_user.id,
-            tokens=num_out_tokens
-        )
+    # Добавляем входные и выходные токены пользователю
+    await usage.record(
+        message.from_user.id,
+        input_tokens=num_in_tokens or 0,
+        output_tokens=num_out_tokens or 0,
+    )
     
     # # Работает, но это встроено в telegramify-markdown
     # for message_to_send in split_message(assistant_reply, with_photo=False):
@@ -82,6 +139,8 @@ async def message_handler(message: Message, db : Database, openai: OpenAI_API, r
     await answer_message(
         md=assistant_reply,
         message=message,
+        delivery=delivery,
     )
 
-
+    # Сжимаем старую часть истории в фоне (после ответа пользователю)
+    compactor.schedule(message.from_user.id, history_len or 0)
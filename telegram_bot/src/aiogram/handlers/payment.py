@@ -14,7 +14,7 @@ from aiogram.types import (
 
 from src.logger import logger
 
-from src.database import Redis, Database
+from src.database import Redis, Database, EntitlementCache
 from src.aiogram.middlewares.middlewares import WaitingMiddleware 
 from src.aiogram.handlers.system import get_payment_keyboard_markup
 
@@ -35,7 +35,7 @@ router = Router()
 router.message.middleware(WaitingMiddleware())
 
 @router.callback_query(F.data == "pay")
-async def pay_callback(callback: CallbackQuery, bot: Bot, db: Database):
+async def pay_callback(callback: CallbackQuery, bot: Bot):
     await send_invoice(
         bot=bot, 
         chat_id=callback.message.chat.id,
@@ -46,13 +46,12 @@ async def pay_callback(callback: CallbackQuery, bot: Bot, db: Database):
     
 
 @router.message(Command("pay"))
-async def pay_handler(message: Message, bot: Bot, db: Database):
+async def pay_handler(message: Message, bot: Bot, entitlements: EntitlementCache):
     user_id = message.from_user.id
+    user_state = await entitlements.get(user_id)
 
-    if await db.is_subscription_active(user_id):
-        sub_expiration_date = await db.get_sub_expiration_date(
-            telegram_id=user_id, user_tz="Europe/Moscow"
-        )
+    if user_state is not None and user_state.is_subscription_active:
+        sub_expiration_date = user_state.sub_expiration_date.astimezone(pytz.timezone("Europe/Moscow"))
         # Форматируем текущую дату окончания подписки
         formatted_date = sub_expiration_date.strftime("%Y-%m-%d %H:%M:%S")
 
@@ -122,7 +121,7 @@ async def on_pre_checkout_query(pre_checkout_query: PreCheckoutQuery):
     logger.debug(f"(PAYMENT)\t Payment confirmed")
 
 @router.message(F.successful_payment)
-async def on_successful_payment(message: Message, db: Database):
+async def on_successful_payment(message: Message, db: Database, entitlements: EntitlementCache):
     await message.answer(
         f"Успешно оплачено {message.successful_payment.total_amount // 100} {message.successful_payment.currency}! \
 \nНомер платежа:\n{message.successful_payment.provider_payment_charge_id}",
@@ -142,4 +141,5 @@ message_effect_id="5104841245755180586",
         is_first_recurring=message.successful_payment.is_first_recurring,
         order_info=message.successful_payment.order_info
     )
-    
+    # Сбрасываем кэш статуса подписки (на всех репликах)
+    await entitlements.invalidate(message.from_user.id)
@@ -2,7 +2,11 @@
 from functools import wraps
 
 from src.logger import logger
-from src.database import Database, Redis
+from src.database import Database, Redis, EntitlementCache, UsageAggregator
+from src.aiogram.utils import DeletionScheduler, DeliveryService
+from src.history_compaction import HistoryCompactor
+from src.tracing import close_traces
+from src.tokens import preload_encoding
 
 from aiogram import Bot, Dispatcher, types, Router
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
@@ -11,16 +15,36 @@ import sys
 
 async def on_startup(db: Database, bot: Bot):
     await db.create_tables_if_not_exist()
+    await preload_encoding()
     # await db.create_tables()
 
 
-async def on_shutdown(db: Database, redis: Redis):
+async def on_shutdown(db: Database, 
+                      redis: Redis, 
+                      entitlements: EntitlementCache, 
+                      usage: UsageAggregator, 
+                      deletion_scheduler: DeletionScheduler,
+                      compactor: HistoryCompactor,
+                      delivery: DeliveryService):
+    # Дожидаемся отправки ответов из очереди
+    await delivery.close()
+    # Удаляем оставшиеся технические сообщения
+    await deletion_scheduler.close()
+    # Дожидаемся фонового сжатия историй
+    await compactor.close()
+
     # await redis.clear_all_history()
-    await redis.clear_all_waitings()
+    # Аренды запросов не удаляем - их могут держать другие реплики, свои истекут по TTL
+
+    await entitlements.close()
+    # Записываем в БД накопленные счетчики запросов/токенов
+    await usage.close()
 
     await redis.close()
     await db.close()
 
+    close_traces()
+
 
 def init_error_handler(func):
     @wraps(func)
@@ -1,6 +1,7 @@
 import asyncio
+import time
 import traceback
-from datetime import datetime
+from functools import partial
 
 from aiogram import BaseMiddleware, Bot
 from aiogram.types import (
@@ -10,19 +11,23 @@ from aiogram.types import (
     )
 from aiogram.enums import ParseMode
 
-from src.database import Database
+from src.database import Database, UserState, EntitlementCache, UsageAggregator
 from src.gpt import OpenAI_API
+from src.history_compaction import HistoryCompactor
+from src.response_cache import ResponseCache
 from src.database import Redis
 from src.config import (
     SUBSCRIPTION_DURATION_MONTHS, 
     TRIAL_PERIOD_NUM_REQ, 
     MAX_HISTORY_LENGTH_TRIAL, 
-    MAX_HISTORY_LENGTH_PAID
+    MAX_HISTORY_LENGTH_PAID,
+    USER_LEASE_TTL_MS
 )
 from src.aiogram.handlers.system import get_payment_keyboard_markup
 from src.prometheus_metrics import MESSAGE_RESPONSE_TIME, MESSAGE_RPS_COUNTER
-from src.aiogram.utils import commands_text
+from src.aiogram.utils import commands_text, DeletionScheduler, DeliveryService
 
+from src.tracing import new_trace, current_trace, trace_span
 from src.logger import logger
 
 
@@ -64,9 +69,9 @@ class ErrorLoggingMiddleware(BaseMiddleware):
             )
 
             # Удаляем историю сессии из Redis
+            # (аренду запроса WaitingMiddleware уже освободил сам - compare-and-delete)
             if telegram_id:
                 await self.redis.clear_user_history(telegram_id)
-                await self.redis.set_user_req_inactive(telegram_id)
 
                 # Уведомляем пользователя
                 await self.bot.send_message(
@@ -82,15 +87,17 @@ class TimingMessageMiddleware(BaseMiddleware):
         """
         Замеряем MESSAGE_RESPONSE_TIME
         """
-        start_time = datetime.now()  # Фиксируем момент получения сообщения ботом
+        received_at = time.time()  # Фиксируем момент получения сообщения ботом
+        start_time = time.monotonic()
 
         result =  await handler(event, data)
         
         if isinstance(event, Message):
-            # Время обработки сообщения основной логикой
-            response_time = (datetime.now() - start_time).total_seconds() 
+            # Время обработки сообщения основной логикой (монотонные часы)
+            response_time = time.monotonic() - start_time
             # Время от отправки сообщения пользователем до начала основной логики
-            message_latency: datetime = (start_time - event.date.replace(tzinfo=None)).total_seconds()  
+            # (event.date - aware UTC, сравниваем в unix time, без часовых поясов)
+            message_latency = max(received_at - event.date.timestamp(), 0)
             # Общее время от отправки до ответа 
             total_latency = message_latency + response_time  
             # Логируем
@@ -100,7 +107,40 @@ class TimingMessageMiddleware(BaseMiddleware):
         
         return result
 
-        
+
+class TracingMiddleware(BaseMiddleware):
+    """
+    Outer middleware для dp.update: создает трассу апдейта (src.tracing)
+    и кладет ее в `data["trace"]`. Трасса завершается после обработки апдейта
+    и отправки всех поставленных в очередь ответов.
+    """
+    async def __call__(self, handler, event: Update, data: dict):
+        user = data.get("event_from_user")
+        trace = new_trace(event.update_id, user.id if user else None)
+        if trace is None:
+            return await handler(event, data)
+
+        data["trace"] = trace
+        token = current_trace.set(trace)
+        try:
+            with trace_span("update"):
+                return await handler(event, data)
+        finally:
+            current_trace.reset(token)
+            trace.release()
+
+
+class TracedMiddleware(BaseMiddleware):
+    """Интервал трассы вокруг другого middleware (включает все, что выполняется после него)"""
+    def __init__(self, middleware: BaseMiddleware):
+        super().__init__()
+        self.middleware = middleware
+        self.name = f"middleware.{type(middleware).__name__}"
+
+    async def __call__(self, handler, event: TelegramObject, data: dict):
+        with trace_span(self.name):
+            return await self.middleware(handler, event, data)
+
 
 class DatabaseMiddleware(BaseMiddleware):
     def __init__(self, db: Database):
@@ -137,8 +177,112 @@ class RedisMiddleware(BaseMiddleware):
         """
         data["redis"] = self.redis
         return await handler(event, data)
+
+
+class EntitlementMiddleware(BaseMiddleware):
+    def __init__(self, entitlements: EntitlementCache):
+        super().__init__()
+        self.entitlements = entitlements
+
+    async def __call__(self, handler, event: TelegramObject, data: dict):
+        """
+        Добавляет объект `entitlements` в `data`, чтобы он был доступен в хендлерах.
+        """
+        data["entitlements"] = self.entitlements
+        return await handler(event, data)
+
+
+class UsageMiddleware(BaseMiddleware):
+    def __init__(self, usage: UsageAggregator):
+        super().__init__()
+        self.usage = usage
+
+    async def __call__(self, handler, event: TelegramObject, data: dict):
+        """
+        Добавляет объект `usage` в `data`, чтобы он был доступен в хендлерах.
+        """
+        data["usage"] = self.usage
+        return await handler(event, data)
+
+
+class DeletionSchedulerMiddleware(BaseMiddleware):
+    def __init__(self, deletion_scheduler: DeletionScheduler):
+        super().__init__()
+        self.deletion_scheduler = deletion_scheduler
+
+    async def __call__(self, handler, event: TelegramObject, data: dict):
+        """
+        Добавляет объект `deletion_scheduler` в `data`, чтобы он был доступен в хендлерах.
+        """
+        data["deletion_scheduler"] = self.deletion_scheduler
+        return await handler(event, data)
+
+
+class DeliveryMiddleware(BaseMiddleware):
+    def __init__(self, delivery: DeliveryService):
+        super().__init__()
+        self.delivery = delivery
+
+    async def __call__(self, handler, event: TelegramObject, data: dict):
+        """
+        Добавляет объект `delivery` в `data`, чтобы он был доступен в хендлерах.
+        """
+        data["delivery"] = self.delivery
+        return await handler(event, data)
+
+
+class ResponseCacheMiddleware(BaseMiddleware):
+    def __init__(self, response_cache: ResponseCache):
+        super().__init__()
+        self.response_cache = response_cache
+
+    async def __call__(self, handler, event: TelegramObject, data: dict):
+        """
+        Добавляет объект `response_cache` в `data`, чтобы он был доступен в хендлерах.
+        """
+        data["response_cache"] = self.response_cache
+        return await handler(event, data)
+
+
+class HistoryCompactorMiddleware(BaseMiddleware):
+    def __init__(self, compactor: HistoryCompactor):
+        super().__init__()
+        self.compactor = compactor
+
+    async def __call__(self, handler, event: TelegramObject, data: dict):
+        """
+        Добавляет объект `compactor` в `data`, чтобы он был доступен в хендлерах.
+        """
+        data["compactor"] = self.compactor
+        return await handler(event, data)
     
     
+class UserStateMiddleware(BaseMiddleware):
+    """
+    Загружает снимок состояния пользователя (UserState) одним запросом
+    и кладет его в `data["user_state"]` для остальных middleware и хендлеров.
+    Должен стоять первым в цепочке (до CheckNewUserMiddleware).
+    """
+    async def __call__(self, handler, event: TelegramObject, data: dict):
+        if isinstance(event, Message):
+            # Получаем кэш статусов пользователей из контекста
+            entitlements: EntitlementCache = data.get("entitlements")
+
+            if entitlements is None:
+                raise ValueError("EntitlementCache instance must be provided in the context data.")
+
+            try:
+                # None - новый пользователь
+                data["user_state"] = await entitlements.get(event.from_user.id)
+            except Exception as e:
+                # Статус пользователя неизвестен - запрос не обрабатываем (иначе он стал бы "новым")
+                logger.error(f"(MAIN)\t\t Error while loading user state {event.from_user.id}: {e}")
+                await event.answer("Сервис временно недоступен. Пожалуйста, повторите запрос позже.")
+                return
+
+        return await handler(event, data)
+
+
 class CheckNewUserMiddleware(BaseMiddleware):
     async def __call__(self, handler, event: TelegramObject, data: dict):
         if isinstance(event, Message):
@@ -147,11 +291,13 @@ class CheckNewUserMiddleware(BaseMiddleware):
             
             if db is None:
                 raise ValueError("Database instance must be provided in the context data.")
+            if "user_state" not in data:
+                raise ValueError("UserStateMiddleware must be registered before CheckNewUserMiddleware.")
         
             # Проверяем, существует ли пользователь в базе данных
-            is_user_exists = await db.is_user_exists(event.from_user.id)
+            user_state: UserState | None = data["user_state"]
 
-            if not is_user_exists:
+            if user_state is None:
                 # Если пользователь новый, отправляем приветственное сообщение
                 text = "\n".join([
                     f"*Привет, {event.from_user.first_name}\\! 👋*",
@@ -176,6 +322,7 @@ class CheckNewUserMiddleware(BaseMiddleware):
                     username=event.from_user.username,
                     language_code=event.from_user.language_code
                 )
+                data["user_state"] = UserState(telegram_id=event.from_user.id)
             
         # Вызываем следующий обработчик
         return await handler(event, data)
@@ -184,16 +331,22 @@ class IncrementRequestsMiddleware(BaseMiddleware):
     async def __call__(self, handler, event: TelegramObject, data: dict):
         result = await handler(event, data)
         if isinstance(event, Message):
-            # Получаем объект базы данных из контекста
-            db = data.get("db")
+            # Получаем объект учета запросов из контекста
+            usage: UsageAggregator = data.get("usage")
+            entitlements: EntitlementCache = data.get("entitlements")
             
-            if db is None:
-                raise ValueError("Database instance must be provided in the context data.")
+            if usage is None:
+                raise ValueError("UsageAggregator instance must be provided in the context data.")
+            if entitlements is None:
+                raise ValueError("EntitlementCache instance must be provided in the context data.")
             
-            # Увеличиваем счетчик запросов пользователя
-            await db.increment_user_requests(event.from_user.id)
-            # Обновляем дату последнего запроса
-            await db.update_last_req_date(event.from_user.id)
+            # Увеличиваем счетчик запросов пользователя и дату последнего запроса
+            user_state = await usage.record(event.from_user.id, requests=1)
+            if user_state is not None:
+                # Запись сразу в БД - берем состояние из UPDATE ... RETURNING
+                await entitlements.set(user_state)
+            else:
+                await entitlements.add_requests(event.from_user.id)
             # Отправляем в Prometheus
             MESSAGE_RPS_COUNTER.inc()
 
@@ -206,19 +359,17 @@ class CheckTrialPeriodMiddleware(BaseMiddleware):
     """
     async def __call__(self, handler, event: TelegramObject, data: dict):
         if isinstance(event, Message):
-            # Получаем объект базы данных из контекста
-            db: Database = data.get("db")
+            # Получаем снимок состояния пользователя из контекста
+            user_state: UserState = data.get("user_state")
             redis: Redis = data.get("redis")
             
-            if db is None:
-                raise ValueError("Database instance must be provided in the context data.")
+            if user_state is None:
+                raise ValueError("UserState must be provided in the context data.")
             if redis is None:
                 raise ValueError("Redis instance must be provided in the context data.")
 
             # Проверяем, подписан ли пользователь
-            is_subscription_active = await db.is_subscription_active(event.from_user.id)
-
-            if not is_subscription_active and not await db.is_user_trial(event.from_user.id):
+            if not user_state.is_subscription_active and not user_state.is_trial:
                 # Если пользователь не подписан и тестовый период закончился, отправляем сообщение о подписке
                 await event.answer(
                     f"Ваш пробный период ({TRIAL_PERIOD_NUM_REQ} запросов) закончился. "
@@ -239,19 +390,17 @@ class CheckSubscriptionMiddleware(BaseMiddleware):
     """
     async def __call__(self, handler, event: TelegramObject, data: dict):
         if isinstance(event, Message):
-            # Получаем объект базы данных из контекста
-            db: Database = data.get("db")
+            # Получаем снимок состояния пользователя из контекста
+            user_state: UserState = data.get("user_state")
             redis: Redis = data.get("redis")
             
-            if db is None:
-                raise ValueError("Database instance must be provided in the context data.")
+            if user_state is None:
+                raise ValueError("UserState must be provided in the context data.")
             if redis is None:
                 raise ValueError("Redis instance must be provided in the context data.")
             
             # Проверяем, подписан ли пользователь
-            is_subscription_active = await db.is_subscription_active(event.from_user.id)
-
-            if not is_subscription_active and not await db.is_user_trial(event.from_user.id):
+            if not user_state.is_subscription_active and not user_state.is_trial:
                 # Если подписка закончилась И не пробный период, отправляем сообщение о продлении подписки
         
                 await event.answer(
@@ -279,35 +428,64 @@ class WaitingMiddleware(BaseMiddleware):
     async def __call__(self, handler, event: TelegramObject, data: dict):
         # Получаем объект базы данных из контекста
         redis: Redis = data.get("redis")
+        deletion_scheduler: DeletionScheduler = data.get("deletion_scheduler")
+        delivery: DeliveryService | None = data.get("delivery")
 
         if redis is None:
             raise ValueError("Redis instance must be provided in the context data.")
+        if deletion_scheduler is None:
+            raise ValueError("DeletionScheduler instance must be provided in the context data.")
 
-        # Проверяем, активен ли запрос пользователя
-        is_user_waiting = await redis.is_user_waiting(event.from_user.id)
+        # Атомарно занимаем обработку запроса пользователя (0 - предыдущий запрос еще обрабатывается)
+        lease_token = await redis.acquire_lease(event.from_user.id, USER_LEASE_TTL_MS)
         
 
         tech_message = None  # Для хранения ссылки на отправленное сообщение
 
-        if is_user_waiting:
+        if lease_token == 0:
             # Если запрос пользователя активен, отправляем сообщение о том, что запрос обрабатывается
             tech_message = await event.answer("Ваш запрос обрабатывается. Пожалуйста, подождите...")
-            asyncio.create_task(delete_message_when_inactive(redis, event.from_user.id, tech_message, event))
+            # Удаляем пользователское сообщение
+            deletion_scheduler.delete_now(event.chat.id, event.message_id)
+            # Техническое сообщение удалится, когда бот ответит на предыдущее сообщение
+            await deletion_scheduler.schedule(
+                tech_message.chat.id, tech_message.message_id,
+                user_id=event.from_user.id, trigger="inactive", delay=120
+            )
             return  # Завершаем выполнение, так как запрос уже обрабатывается
         
         
-        # Отправляем техническое сообщение с точками
-        tech_message = await event.answer(". . . . . .")
-        # Устанавливаем флаг активности запроса пользователя
-        await redis.set_user_req_active(event.from_user.id)
-        # Ожидаем когда запрос станет неактивным
-        asyncio.create_task(delete_message_when_inactive(redis, event.from_user.id, tech_message))
-        # Вызываем следующий обработчик
-        result = await handler(event, data)
-        # Удаляем флаг активности запроса пользователя
-        await redis.set_user_req_inactive(event.from_user.id)
+        # Продлеваем аренду, пока выполняется запрос (например, долгий ответ OpenAI)
+        keep_lease_task = None
+        if lease_token:
+            keep_lease_task = asyncio.create_task(
+                redis.keep_lease(event.from_user.id, lease_token, USER_LEASE_TTL_MS)
+            )
+
+        try:
+            # Отправляем техническое сообщение с точками (в него же выводится потоковый ответ)
+            tech_message = await event.answer(". . . . . .")
+            data["tech_message"] = tech_message
+            # Fencing-токен - запись истории только пока аренда наша
+            data["lease_token"] = lease_token
+            # Удаляем, когда запрос станет неактивным
+            await deletion_scheduler.schedule(
+                tech_message.chat.id, tech_message.message_id,
+                user_id=event.from_user.id, trigger="inactive", delay=120
+            )
+            # Вызываем следующий обработчик
+            result = await handler(event, data)
+        finally:
+            # Ответ уходит через очередь отправки - запрос завершен, когда пользователь его получил
+            # (иначе техническое сообщение удалится раньше, чем придет ответ)
+            if delivery is not None:
+                await delivery.wait(event.chat.id, timeout=USER_LEASE_TTL_MS / 1000)
+            if keep_lease_task:
+                keep_lease_task.cancel()
+            # Освобождаем аренду (только свою)
+            if lease_token:
+                await redis.release_lease(event.from_user.id, lease_token)
 
-        
         return result
 
 
@@ -327,21 +505,42 @@ class CheckHistoryLengthMiddleware(BaseMiddleware):
         else:
             return False
 
+    @staticmethod
+    async def notify(message: Message, delivery: DeliveryService | None, text: str, **kwargs) -> Message | None:
+        """
+        Техническое сообщение после ответа: через очередь отправки чата, чтобы оно пришло после ответа.
+        Возвращает отправленное сообщение (None - не удалось отправить, ошибка уже залогирована)
+        """
+        send = partial(message.answer, text, **kwargs)
+        if delivery is None:
+            return await send()
+        try:
+            return await delivery.send(message.chat.id, send)
+        except Exception:
+            return None
+
 
     async def __call__(self, handler, event: TelegramObject, data: dict):
         # Получаем объект базы данных из контекста
         redis: Redis = data.get("redis")
-        db: Database = data.get("db")
+        user_state: UserState = data.get("user_state")
+        deletion_scheduler: DeletionScheduler = data.get("deletion_scheduler")
+        delivery: DeliveryService | None = data.get("delivery")
 
         if redis is None:
             raise ValueError("Redis instance must be provided in the context data.")
-        if db is None:
-            raise ValueError("Database instance must be provided in the context data.")
-
-        history: list[dict] = await redis.get_history(event.from_user.id)
-        history_mes_count = len(history) // 2  # Целочисленное деление
-
-        is_sub_active = await db.is_subscription_active(event.from_user.id)
+        if deletion_scheduler is None:
+            raise ValueError("DeletionScheduler instance must be provided in the context data.")
+        if user_state is None:
+            raise ValueError("UserState must be provided in the context data.")
+
+        # Длина истории без загрузки и декодирования самих сообщений (LLEN).
+        # Сама история загружается один раз - в хендлере
+        history_len = await redis.get_history_length(event.from_user.id) or 0
+        data["history_len"] = history_len
+        history_mes_count = history_len // 2  # Целочисленное деление
+
+        is_sub_active = user_state.is_subscription_active
         if is_sub_active:
             max_history = MAX_HISTORY_LENGTH_PAID
         else:
@@ -357,15 +556,20 @@ class CheckHistoryLengthMiddleware(BaseMiddleware):
         if history_mes_count >= max_history:
             # Закончился лимит истории
             if is_sub_active:
-                tech_message = await event.answer(
+                await self.notify(
+                    event, delivery,
                     f"*💬 Превышен лимит истории в `{max_history}` сообщений\\.*\n\n"
                     "🔹 Используйте команду */reset\\_conversation*, чтобы сбросить диалог и начать общение с чиcтого листа\\.\n"
                     "🔹 */help* \\- помощь\n",
                     parse_mode=ParseMode.MARKDOWN_V2
                 )
             else:
+                # Сбрасываем диалог, когда ответ уже у пользователя
+                if delivery is not None:
+                    await delivery.wait(event.chat.id)
                 await redis.clear_user_history(event.from_user.id)
-                await event.answer(
+                await self.notify(
+                    event, delivery,
                     f"*💬 Превышен лимит истории в `{max_history}` сообщений\\.*\n\n"
                     "Ваш диалог был сброшен\\. Вы можете продолжить общение с чиcтого листа\\.\n"
                     f"Для увеличения диалога до `{MAX_HISTORY_LENGTH_PAID}` сообщений, оплатите подписку\\.\n",
@@ -385,46 +589,18 @@ class CheckHistoryLengthMiddleware(BaseMiddleware):
             
             # logger.debug(f"remain_messages: {remain_messages}")
 
-            tech_message = await event.answer(
+            tech_message = await self.notify(
+                event, delivery,
                 f"*💬 У вас осталось `{remain_messages}/{max_history}` сообщений до сброса диалога\\.\\.\\.*\n\n"
                 "🔹 Если сменили тему, используйте команду */reset\\_conversation*, чтобы начать с чистого листа\\.\n"
                 "🔹 Это ускорит время ответа и улучшит понимание контекста\\. ⏳",
                 parse_mode=ParseMode.MARKDOWN_V2
             )
-            # Создаем задачу на удаление сообщения
-            asyncio.create_task(delete_message_when_active(redis, event.from_user.id, tech_message))
+            # Удаляем сообщение, когда пользователь снова что-то отправит
+            if tech_message is not None:
+                await deletion_scheduler.schedule(
+                    tech_message.chat.id, tech_message.message_id,
+                    user_id=event.from_user.id, trigger="active"
+                )
 
         return result
-
-
-async def delete_message_when_inactive(
-            redis: Redis, 
-            user_id: int,
-            tech_message: TelegramObject, 
-            user_message: TelegramObject = None
-            ):
-        """
-        Ожидает, пока пользователь ждет ответа.
-        """
-        # Удаляем пользователское сообщение
-        if user_message: await user_message.delete()
-
-        while await redis.is_user_waiting(user_id):
-            # Ожидаем пока юзеру ответит бот на предыдущее сообщение
-            await asyncio.sleep(0.1)
-
-        # Удаляем техническое сообщение
-        await tech_message.delete()
-        
-
-
-async def delete_message_when_active(   redis: Redis, 
-                                        user_id: int, 
-                                        tech_message: TelegramObject):
-    """
-    Удаляем сообщение, когда пользователь снова что-то отправит
-    """
-    while not await redis.is_user_waiting(user_id):
-        await asyncio.sleep(0.5)
-
-    await tech_message.delete()
@@ -1,3 +1,6 @@
-from .message_split import split_message
+from .message_split import split_message, MessageChunker
 from .answer_message import answer_message
-from .text import commands_text
\ No newline at end of file
+from .text import commands_text
+from .deletion_scheduler import DeletionScheduler
+from .stream_editor import StreamingEditor
+from .delivery import DeliveryService
@@ -1,40 +1,39 @@
-import telegramify_markdown
 from telegramify_markdown.customize import markdown_symbol
-from telegramify_markdown.interpreters import BaseInterpreter, MermaidInterpreter
 from telegramify_markdown.type import ContentTypes
 
 from aiogram.types import Message
 from aiogram.enums import ParseMode
 
 from src.logger import logger
+from .delivery import DeliveryService
+from .render import render_markdown
 
-import asyncio
+from functools import partial
 
 
 # Copied from 
 # https://github.com/sudoskys/telegramify-markdown/blob/main/playground/telegramify_case.py
 
 
-async def answer_message(md: str, message: Message):
-    boxs = await telegramify_markdown.telegramify(
-        content=md,
-        interpreters_use=[BaseInterpreter(), MermaidInterpreter(session=None)],  # Render mermaid diagram
-        latex_escape=True,
-        normalize_whitespace=True,
-        max_word_count=4090  # The maximum number of words in a single message.
-    )
+async def answer_message(md: str, message: Message, delivery: DeliveryService | None = None):
+    """
+    Отправить ответ в MarkdownV2 (разбивается на несколько сообщений).
+    Если задан delivery - сообщения ставятся в очередь отправки и функция не ждет их доставки.
+    """
+    boxs = await render_markdown(md)
     for item in boxs:
-        """
-        Telegram имеет ограничения на количество сообщений, отправляемых за короткий промежуток времени. 
-        Если сервер медленный, он может не успеть обработать несколько сообщений до того, как Telegram ограничит отправку.
-        """
-        await asyncio.sleep(0.5)
+        # Ограничения Telegram на частоту отправки соблюдает DeliveryService
         try:
             if item.content_type == ContentTypes.TEXT:
-                await message.answer(
+                send = partial(
+                    message.answer,
                     item.content,
                     parse_mode=ParseMode.MARKDOWN_V2
                 )
+                if delivery is not None:
+                    delivery.send(message.chat.id, send)
+                else:
+                    await send()
             '''
             elif item.content_type == ContentTypes.PHOTO:
                 print("PHOTO")
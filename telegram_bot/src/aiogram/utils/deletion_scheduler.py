@@ -0,0 +1,188 @@
+import asyncio
+import heapq
+import itertools
+import time
+from dataclasses import dataclass, field
+
+from aiogram import Bot
+
+from src.database import Redis
+from src.config import DELETION_MAX_PENDING, DELETION_MAX_DELAY
+from src.prometheus_metrics import PENDING_DELETIONS
+from src.logger import logger
+
+
+@dataclass(order=True)
+class Deletion:
+    deadline: float
+    seq: int
+    chat_id: int = field(compare=False)
+    message_id: int = field(compare=False)
+    key: tuple[int, str] = field(compare=False)
+    done: bool = field(default=False, compare=False)
+
+
+class DeletionScheduler:
+    """
+    Единый планировщик удаления технических сообщений.
+    Сообщение удаляется, когда запрос пользователя становится в нужное состояние
+    (trigger = "inactive" / "active", уведомление из Redis Pub/Sub) или по истечении deadline.
+    Удаления копятся и отправляются пачками (deleteMessages) одной фоновой задачей.
+    Количество ожидающих удалений ограничено DELETION_MAX_PENDING.
+    Повторное планирование того же сообщения заменяет прежнее условие.
+    """
+    BATCH_SIZE = 100  # Ограничение deleteMessages
+
+    def __init__(self, bot: Bot, redis: Redis):
+        self.bot = bot
+        self.redis = redis
+        self.heap: list[Deletion] = []
+        self.by_key: dict[tuple[int, str], list[Deletion]] = {}
+        self.by_message: dict[tuple[int, int], Deletion] = {}
+        self.due: dict[int, list[int]] = {}
+        self.pending = 0
+        self.seq = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.resync_task = None
+
+    @classmethod
+    async def create(cls, bot: Bot, redis: Redis):
+        self = cls(bot, redis)
+        self.redis.waiters.add_listener(self.on_user_state, resync=self.resync)
+        self.task = asyncio.create_task(self.run())
+        return self
+
+    async def schedule(self, chat_id: int, message_id: int, *,
+                       user_id: int,
+                       trigger: str,
+                       delay: float = DELETION_MAX_DELAY):
+        """
+        Удалить сообщение, когда запрос пользователя станет `trigger` ("inactive" / "active"),
+        но не позже чем через `delay` секунд.
+        """
+        previous = self.by_message.get((chat_id, message_id))
+        if previous is not None and not previous.done:
+            self._cancel(previous)
+
+        if self.pending >= DELETION_MAX_PENDING:
+            # Очередь переполнена - удаляем самое старое, не дожидаясь условия
+            while self.heap:
+                oldest = heapq.heappop(self.heap)
+                if not oldest.done:
+                    self._mark_due(oldest)
+                    break
+
+        key = (int(user_id), trigger)
+        deletion = Deletion(
+            deadline=time.monotonic() + delay,
+            seq=next(self.seq),
+            chat_id=chat_id,
+            message_id=message_id,
+            key=key,
+        )
+        heapq.heappush(self.heap, deletion)
+        self.by_key.setdefault(key, []).append(deletion)
+        self.by_message[(chat_id, message_id)] = deletion
+        self.pending += 1
+        PENDING_DELETIONS.set(self.pending)
+        self.wakeup.set()
+
+        # Запрос мог завершиться до регистрации - проверяем один раз.
+        # "active" - это именно следующий запрос пользователя, текущий не считается
+        if trigger == "inactive" and not await self.redis.is_user_waiting(user_id):
+            self.on_user_state(user_id, trigger)
+
+    def delete_now(self, chat_id: int, message_id: int):
+        """Удалить сообщение при ближайшей отправке пачки"""
+        self.due.setdefault(chat_id, []).append(message_id)
+        self.wakeup.set()
+
+    def on_user_state(self, user_id, state: str):
+        """Запрос пользователя сменил состояние - удаляем ожидающие этого сообщения"""
+        for deletion in self.by_key.pop((int(user_id), state), ()):
+            self._mark_due(deletion)
+
+    def resync(self):
+        """Уведомления Pub/Sub могли потеряться - перепроверяем ожидающие завершения запроса"""
+        if self.resync_task is None or self.resync_task.done():
+            self.resync_task = asyncio.create_task(self._resync())
+
+    async def _resync(self):
+        for user_id, trigger in list(self.by_key):
+            if trigger == "inactive" and not await self.redis.is_user_waiting(user_id):
+                self.on_user_state(user_id, trigger)
+
+    def _mark_due(self, deletion: Deletion):
+        if deletion.done:
+            return
+        self._cancel(deletion)
+        self.delete_now(deletion.chat_id, deletion.message_id)
+
+    def _cancel(self, deletion: Deletion):
+        """Снять удаление с ожидания (запись в куче чистится в run)"""
+        deletion.done = True
+        self.pending -= 1
+        PENDING_DELETIONS.set(self.pending)
+        deletions = self.by_key.get(deletion.key)
+        if deletions and deletion in deletions:
+            deletions.remove(deletion)
+            if not deletions:
+                del self.by_key[deletion.key]
+        message_key = (deletion.chat_id, deletion.message_id)
+        if self.by_message.get(message_key) is deletion:
+            del self.by_message[message_key]
+
+    async def run(self):
+        while True:
+            # Просроченные удаления
+            now = time.monotonic()
+            while self.heap and (self.heap[0].done or self.heap[0].deadline <= now):
+                self._mark_due(heapq.heappop(self.heap))
+            if len(self.heap) > 2 * self.pending + 64:
+                # Сработавшие по условию удаления остаются в куче до своего deadline - чистим
+                self.heap = [deletion for deletion in self.heap if not deletion.done]
+                heapq.heapify(self.heap)
+
+            if self.due:
+                await self.flush()
+
+            timeout = max(self.heap[0].deadline - time.monotonic(), 0) if self.heap else None
+            self.wakeup.clear()
+            if self.due:
+                continue
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def flush(self):
+        """Отправить накопленные удаления пачками по чатам"""
+        due, self.due = self.due, {}
+        for chat_id, message_ids in due.items():
+            for i in range(0, len(message_ids), self.BATCH_SIZE):
+                batch = message_ids[i:i + self.BATCH_SIZE]
+                try:
+                    if len(batch) == 1:
+                        await self.bot.delete_message(chat_id=chat_id, message_id=batch[0])
+                    else:
+                        await self.bot.delete_messages(chat_id=chat_id, message_ids=batch)
+                except Exception as e:
+                    logger.error(f"(Deletion)\t Error deleting messages {batch} in chat {chat_id}: {e}")
+
+    async def close(self):
+        """Удалить все ожидающие технические сообщения и остановить планировщик"""
+        self.redis.waiters.remove_listener(self.on_user_state, resync=self.resync)
+        if self.resync_task:
+            self.resync_task.cancel()
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        for deletion in self.heap:
+            self._mark_due(deletion)
+        self.heap.clear()
+        await self.flush()
+        logger.info("(Deletion)\t Deletion scheduler closed")
@@ -0,0 +1,125 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from src.ratelimit import TokenBucket
+from src.config import (
+    DELIVERY_GLOBAL_RATE,
+    DELIVERY_CHAT_RATE,
+    DELIVERY_CHAT_BURST,
+    DELIVERY_MAX_RETRIES,
+    DELIVERY_MAX_CHATS,
+)
+from src.prometheus_metrics import PENDING_DELIVERIES, ERRORS_COUNTER, timed
+from src.tracing import current_trace
+from src.logger import logger
+
+
+@dataclass
+class ChatQueue:
+    bucket: TokenBucket
+    items: deque = field(default_factory=deque)
+    task: asyncio.Task | None = None
+
+
+class DeliveryService:
+    """
+    Очередь исходящих сообщений Telegram.
+    Отправки одного чата выполняются по порядку, с ограничением на чат (DELIVERY_CHAT_RATE в секунду,
+    всплеск до DELIVERY_CHAT_BURST) и общим ограничением бота (DELIVERY_GLOBAL_RATE в секунду).
+    При TelegramRetryAfter чат ждет указанное время и повторяет отправку.
+    Первые сообщения чата уходят без задержки. Хендлер не ждет отправки (send возвращает Future).
+    """
+    def __init__(self):
+        self.global_bucket = TokenBucket(DELIVERY_GLOBAL_RATE, period=1)
+        self.chats: dict[int, ChatQueue] = {}
+        self.pending = 0
+
+    def send(self, chat_id: int, method: Callable[[], Awaitable[Any]]) -> asyncio.Future:
+        """
+        Поставить отправку в очередь чата. method - функция без аргументов,
+        выполняющая запрос к Bot API (например, partial(bot.send_message, chat_id, text)).
+        """
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            if len(self.chats) >= DELIVERY_MAX_CHATS:
+                self._prune()
+            chat = self.chats[chat_id] = ChatQueue(
+                bucket=TokenBucket(DELIVERY_CHAT_BURST, period=DELIVERY_CHAT_BURST / DELIVERY_CHAT_RATE)
+            )
+        future = asyncio.get_running_loop().create_future()
+        # Отправка - часть трассы апдейта, который ее поставил
+        trace = current_trace.get()
+        if trace is not None:
+            trace.hold()
+        chat.items.append((method, future, trace))
+        self.pending += 1
+        PENDING_DELIVERIES.set(self.pending)
+        if chat.task is None:
+            chat.task = asyncio.create_task(self._run_chat(chat_id, chat))
+        return future
+
+    async def wait(self, chat_id: int, timeout: float | None = None):
+        """Дождаться отправки всего, что уже стоит в очереди чата (ошибки отправки не пробрасываются)"""
+        chat = self.chats.get(chat_id)
+        if chat is None or not chat.items:
+            return
+        # Отправки чата выполняются по порядку - достаточно дождаться последней
+        _, future, _ = chat.items[-1]
+        await asyncio.wait([future], timeout=timeout)
+
+    async def _run_chat(self, chat_id: int, chat: ChatQueue):
+        try:
+            while chat.items:
+                method, future, trace = chat.items[0]
+                trace_token = current_trace.set(trace)
+                try:
+                    result = await self._deliver(chat, method)
+                    if not future.done():
+                        future.set_result(result)
+                except Exception as e:
+                    logger.error(f"(Delivery)\t Error sending to chat {chat_id}: {e}")
+                    ERRORS_COUNTER.labels(error_type=e.__class__.__name__).inc()
+                    if not future.done():
+                        future.set_exception(e)
+                        future.exception()  # Ошибка уже залогирована - не ждем, что ее прочитают
+                finally:
+                    current_trace.reset(trace_token)
+                    if trace is not None:
+                        trace.release()
+                    chat.items.popleft()
+                    self.pending -= 1
+                    PENDING_DELIVERIES.set(self.pending)
+        finally:
+            chat.task = None
+
+    async def _deliver(self, chat: ChatQueue, method: Callable[[], Awaitable[Any]]):
+        for attempt in range(DELIVERY_MAX_RETRIES + 1):
+            await chat.bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                return await timed("telegram", "send")(method)()
+            except TelegramRetryAfter as e:
+                if attempt == DELIVERY_MAX_RETRIES:
+                    raise
+                logger.warning(f"(Delivery)\t Flood control, retry in {e.retry_after}s")
+                # Остальные сообщения чата ждут в очереди за этим
+                await asyncio.sleep(e.retry_after)
+
+    def _prune(self):
+        """Забыть чаты без очереди с полностью восстановленным лимитом"""
+        for chat_id in [chat_id for chat_id, chat in self.chats.items()
+                        if chat.task is None and chat.bucket.is_full]:
+            del self.chats[chat_id]
+
+    async def close(self, timeout: float = 10):
+        """Дождаться отправки оставшихся сообщений"""
+        tasks = [chat.task for chat in self.chats.values() if chat.task]
+        if tasks:
+            done, not_done = await asyncio.wait(tasks, timeout=timeout)
+            for task in not_done:
+                task.cancel()
+        logger.info("(Delivery)\t Delivery service closed")
@@ -1,58 +1,182 @@
+import re
+from typing import Callable, Iterator
+
+
+MAX_MESSAGE_LENGTH = 4096
+MAX_CAPTION_LENGTH = 1024
+
+# Fenced code block line: ``` / ~~~ (3 or more) with optional info string.
+FENCE = re.compile(r" {0,3}(`{3,}|~{3,})[ \t]*([^`\n]*?)[ \t]*$")
+# Inline markers that must be closed before a break inside a line.
+INLINE = re.compile(r"`+|\*\*|~~")
+
+
+class MessageChunker:
+    """
+    Incremental split of markdown text into parts considering Telegram limits.
+
+    Text is passed with feed() (e.g. deltas of an OpenAI stream), ready parts
+    are yielded as soon as the buffered text exceeds the limit, the rest - by flush().
+    The buffer is walked by offsets, so the whole text is processed in linear time.
+
+    A break is searched for by a newline, then by a space in the second half of the part,
+    otherwise the part is cut at the limit. If the break is inside a fenced code block,
+    the block is closed at the end of the part and reopened (with its language)
+    at the start of the next one; the same is done for `code`, **bold** and ~~strike~~
+    within a line. Parts stay markdown - escaping (MarkdownV2) is done per part later,
+    so the limits can be checked on the sent text with `length` (e.g. length after escaping):
+    a part that does not fit is cut again at a proportionally smaller budget.
+    """
+
+    def __init__(self, *, with_photo: bool = False,
+                 max_length: int = MAX_MESSAGE_LENGTH, caption_length: int = MAX_CAPTION_LENGTH,
+                 length: Callable[[str], int] = len):
+        self.with_photo = with_photo
+        self.max_length = max_length
+        self.caption_length = caption_length
+        self.length = length
+
+        self._buffer = ""       # Text not yet yielded starts at self._pos
+        self._pos = 0
+        self._pieces: list[str] = []  # Fed text not yet joined into the buffer
+        self._pieces_length = 0
+
+        # Markup state at self._pos
+        self._fence: tuple[str, str] | None = None  # (marker, info) of an open code block
+        self._inline: list[str] = []                # Open inline markers of a cut line
+        self._prefix = ""                           # Reopening markup for the next part
+        self.parts_count = 0
+
+    @property
+    def limit(self) -> int:
+        # Photo is sent only with the first message
+        if self.with_photo and self.parts_count == 0:
+            return self.caption_length
+        return self.max_length
+
+    def _pending(self) -> int:
+        return len(self._prefix) + len(self._buffer) - self._pos + self._pieces_length
+
+    def feed(self, text: str) -> Iterator[str]:
+        """Add text, yield the parts that are already complete"""
+        if text:
+            self._pieces.append(text)
+            self._pieces_length += len(text)
+        if self._pending() <= self.limit:
+            return
+        yield from self._drain()
+
+    def flush(self) -> Iterator[str]:
+        """Yield the rest of the text"""
+        yield from self._drain()
+        # The rest fits by characters, but may not fit by the sent length
+        while self._pos < len(self._buffer) and self.length(self._rest()) > self.limit:
+            yield self._cut()
+        if self._pos < len(self._buffer):
+            part = self._prefix + self._buffer[self._pos:]
+            self._buffer, self._pos, self._prefix = "", 0, ""
+            self.parts_count += 1
+            yield part
+
+    def _rest(self) -> str:
+        return self._prefix + self._buffer[self._pos:]
+
+    def _drain(self) -> Iterator[str]:
+        if self._pieces:
+            # The remaining buffer is not longer than the limit - copying is amortized by yielded parts
+            self._buffer = self._buffer[self._pos:] + "".join(self._pieces)
+            self._pos = 0
+            self._pieces.clear()
+            self._pieces_length = 0
+
+        while self._pending() > self.limit:
+            yield self._cut()
+
+    def _cut(self) -> str:
+        buffer, start = self._buffer, self._pos
+        budget = self.limit - len(self._prefix)
+        end = min(start + budget, len(buffer))
+
+        while True:
+            cut, skip = self._find_break(buffer, start, end)
+            fence, inline = self._scan(buffer, start, cut, skip)
+            if fence:
+                closing, reopening = "\n" + fence[0], fence[0] + fence[1] + "\n"
+            else:
+                closing, reopening = "".join(reversed(inline)), "".join(inline)
+            part = self._prefix + buffer[start:cut] + closing
+            if end - start <= len(closing) + 1:
+                break
+            if cut - start + len(closing) > budget:
+                # The closing markup does not fit - search for a break earlier
+                end = start + budget - len(closing)
+                continue
+            if self.length is len or (length := self.length(part)) <= self.limit:
+                break
+            # The sent text is longer than the source (escaping) - shrink the part proportionally
+            end = max(start + (cut - start) * self.limit // length, start + 1)
+
+        self._pos = cut + skip
+        self._fence, self._inline, self._prefix = fence, inline, reopening
+        self.parts_count += 1
+        return part
+
+    @staticmethod
+    def _find_break(buffer: str, start: int, end: int) -> tuple[int, int]:
+        """Break position and the length of the separator dropped at it"""
+        middle = start + (end - start) // 2
+        newline = buffer.rfind("\n", middle, end + 1)
+        if newline != -1:
+            return newline, 1
+        space = buffer.rfind(" ", middle, end + 1)
+        if space != -1:
+            return space, 1
+        return end, 0
+
+    def _scan(self, buffer: str, start: int, cut: int, skip: int):
+        """Fence and inline markup state at the break position"""
+        fence = self._fence
+        line_start = start
+        if buffer.find("`", start, cut) == -1 and buffer.find("~", start, cut) == -1:
+            # No fence lines - only the last line matters
+            line_start = cut + 1 if skip and buffer[cut] == "\n" else buffer.rfind("\n", start, cut) + 1 or start
+        while line_start <= cut:
+            line_end = buffer.find("\n", line_start, cut)
+            if line_end == -1:
+                if skip and buffer[cut] == "\n":
+                    line_end = cut  # The line ends at the break
+                else:
+                    break
+            match = FENCE.match(buffer, line_start, line_end)
+            if match:
+                marker, info = match.groups()
+                if fence is None:
+                    fence = (marker, info)
+                elif marker[0] == fence[0][0] and len(marker) >= len(fence[0]) and not info:
+                    fence = None
+            line_start = line_end + 1
+
+        if fence or line_start > cut:
+            return fence, []
+
+        # The line is cut - close the inline markers open before the break
+        inline = list(self._inline) if line_start == start else []
+        for match in INLINE.finditer(buffer, line_start, cut):
+            marker = match.group()
+            if inline and inline[-1].startswith("`"):
+                if marker == inline[-1]:
+                    inline.pop()
+            elif marker in inline:
+                inline.remove(marker)
+            else:
+                inline.append(marker)
+        return None, inline
+
 
 def split_message(msg: str, *, with_photo: bool) -> list[str]:
     """Split the text into parts considering Telegram limits."""
-    parts = []
-    while msg:
-        # Determine the maximum message length based on
-        # with_photo and whether it's the first iteration
-        # (photo is sent only with the first message).
-        if parts:
-            max_msg_length = 4096
-        elif with_photo:
-            max_msg_length = 1024
-        else:
-            max_msg_length = 4096
-
-        if len(msg) <= max_msg_length:
-            # The message length fits within the maximum allowed.
-            parts.append(msg)
-            break
-
-        # Cut a part of the message with the maximum length from msg
-        # and find a position for a break by a newline character.
-        part = msg[:max_msg_length]
-        first_ln = part.rfind("\n")
-
-        if first_ln != -1:
-            # Newline character found.
-            # Split the message by it, excluding the character itself.
-            new_part = part[:first_ln]
-            parts.append(new_part)
-
-            # Trim msg to the length of the new part
-            # and remove the newline character.
-            msg = msg[first_ln + 1 :]
-            continue
-
-        # No newline character found in the message part.
-        # Try to find at least a space for a break.
-        first_space = part.rfind(" ")
-
-        if first_space != -1:
-            # Space character found. 
-            # Split the message by it, excluding the space itself.
-            new_part = part[:first_space]
-            parts.append(new_part)
-            
-            # Trimming msg to the length of the new part
-            # and removing the space.
-            msg = msg[first_space + 1 :]
-            continue
-
-        # No suitable place for a break found in the message part.
-        # Add the current part and trim the message to its length.
-        parts.append(part)
-        msg = msg[max_msg_length:]
-
-    return parts
-
+    if len(msg) <= (MAX_CAPTION_LENGTH if with_photo else MAX_MESSAGE_LENGTH):
+        # The message length fits within the maximum allowed.
+        return [msg] if msg else []
+    chunker = MessageChunker(with_photo=with_photo)
+    return [*chunker.feed(msg), *chunker.flush()]
@@ -0,0 +1,92 @@
+import asyncio
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import telegramify_markdown
+from telegramify_markdown.interpreters import BaseInterpreter, MermaidInterpreter
+
+from src.config import RENDER_THREAD_MIN_CHARS
+from src.prometheus_metrics import timed
+from .message_split import MessageChunker
+
+
+MAX_RENDERED_LENGTH = 4090  # The maximum number of words in a single message.
+
+# Интерпретаторы не хранят состояния между вызовами - создаем один раз
+BASE_INTERPRETER = BaseInterpreter()
+MERMAID_INTERPRETER = MermaidInterpreter(session=None)  # Render mermaid diagram
+
+MERMAID_FENCE = re.compile(r"^\s*(```|~~~)\s*mermaid\b", re.IGNORECASE | re.MULTILINE)
+
+# mistletoe (внутри telegramify) регистрирует токены рендерера в глобальном состоянии модуля,
+# поэтому два рендера одновременно (в цикле событий и в потоке) выполнять нельзя
+_render_lock = threading.Lock()
+# Рендеры в потоке выполняются по одному в собственном потоке, не занимая пул по умолчанию
+# (asyncio.to_thread) ожиданием блокировки
+_render_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="render")
+
+
+def _interpreters(md: str) -> list:
+    if MERMAID_FENCE.search(md):
+        return [BASE_INTERPRETER, MERMAID_INTERPRETER]
+    return [BASE_INTERPRETER]
+
+
+def _escaped_length(md: str) -> int:
+    return len(telegramify_markdown.markdownify(md, latex_escape=True, normalize_whitespace=True))
+
+
+def _split_markdown(md: str) -> list[str]:
+    """
+    Части markdown, каждая из которых после экранирования MarkdownV2 помещается в сообщение.
+    Иначе telegramify отправляет слишком длинный блок (код, абзац) файлом, а не текстом
+    """
+    if len(md) * 2 <= MAX_RENDERED_LENGTH:
+        # Экранирование увеличивает текст не больше чем вдвое
+        return [md]
+    chunker = MessageChunker(max_length=MAX_RENDERED_LENGTH, length=_escaped_length)
+    return [*chunker.feed(md), *chunker.flush()]
+
+
+async def _telegramify(md: str):
+    boxs = []
+    for part in _split_markdown(md):
+        boxs.extend(await telegramify_markdown.telegramify(
+            content=part,
+            interpreters_use=_interpreters(part),
+            latex_escape=True,
+            normalize_whitespace=True,
+            max_word_count=MAX_RENDERED_LENGTH
+        ))
+    return boxs
+
+
+def _render_in_thread(md: str):
+    with _render_lock:
+        # Отдельный цикл событий потока (MermaidInterpreter делает HTTP запросы)
+        return asyncio.run(_telegramify(md))
+
+
+@timed("render", "loop")
+async def _render_in_loop(md: str):
+    try:
+        return await _telegramify(md)
+    finally:
+        _render_lock.release()
+
+
+@timed("render", "thread")
+async def _render_threaded(md: str):
+    return await asyncio.get_running_loop().run_in_executor(_render_executor, _render_in_thread, md)
+
+
+async def render_markdown(md: str) -> list:
+    """
+    Markdown -> список частей для отправки в MarkdownV2 (telegramify_markdown).
+    Короткие тексты обрабатываются сразу, длинные (от RENDER_THREAD_MIN_CHARS символов)
+    и те, что пришли во время другого рендера, - в отдельном потоке, не блокируя цикл событий.
+    """
+    if len(md) < RENDER_THREAD_MIN_CHARS and _render_lock.acquire(blocking=False):
+        return await _render_in_loop(md)
+    return await _render_threaded(md)
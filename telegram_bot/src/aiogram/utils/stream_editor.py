@@ -0,0 +1,54 @@
+import asyncio
+import time
+
+from aiogram.types import Message
+
+from src.config import STREAM_EDIT_INTERVAL
+from src.logger import logger
+
+
+class StreamingEditor:
+    """
+    Показывает потоковый ответ OpenAI, редактируя техническое сообщение (". . . . . .").
+    Редактирование не чаще раза в STREAM_EDIT_INTERVAL секунд и не блокирует чтение потока.
+    Текст выводится без разметки - итоговый MarkdownV2 отправляется после получения всего ответа.
+    """
+    MAX_LENGTH = 4096
+
+    def __init__(self, message: Message):
+        self.message = message
+        self.parts: list[str] = []
+        self.last_edit = 0.0
+        self.last_text = None
+        self.edit_task: asyncio.Task | None = None
+
+    async def __call__(self, delta: str):
+        self.parts.append(delta)
+        if self.edit_task and not self.edit_task.done():
+            return
+        if time.monotonic() - self.last_edit < STREAM_EDIT_INTERVAL:
+            return
+        self.last_edit = time.monotonic()
+        self.edit_task = asyncio.create_task(self.edit())
+
+    def text(self) -> str:
+        text = "".join(self.parts).strip()
+        if len(text) > self.MAX_LENGTH:
+            # Показываем конец ответа
+            text = "…" + text[-(self.MAX_LENGTH - 1):]
+        return text
+
+    async def edit(self):
+        text = self.text()
+        if not text or text == self.last_text:
+            return
+        try:
+            await self.message.edit_text(text)
+            self.last_text = text
+        except Exception as e:
+            logger.debug(f"(Stream)\t Edit message error: {e}")
+
+    async def close(self):
+        """Дождаться последнего редактирования"""
+        if self.edit_task:
+            await self.edit_task
@@ -0,0 +1,98 @@
+import asyncio
+import signal
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+
+from src.config import (
+    WEBHOOK_BASE_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_MAX_IN_FLIGHT,
+    WEBAPP_HOST,
+    WEBAPP_PORT,
+)
+from src.logger import logger
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    """
+    Обработчик webhook с ограничением количества одновременно обрабатываемых апдейтов.
+    При достижении лимита ответ Telegram задерживается, пока не освободится место
+    (Telegram не отправит больше max_connections запросов одновременно).
+    """
+    def __init__(self, *args, max_in_flight: int, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_in_flight = max_in_flight
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        await self.in_flight.acquire()
+        started = False
+        try:
+            update = await request.json(loads=bot.session.json_loads)
+            feed_update_task = asyncio.create_task(self._background_feed_update(bot=bot, update=update))
+            started = True
+        finally:
+            # Место освобождается задачей, а если она не создана (ошибка, отмена) - сразу
+            if not started:
+                self.in_flight.release()
+        feed_update_task.add_done_callback(lambda _: self.in_flight.release())
+        self._background_feed_update_tasks.add(feed_update_task)
+        feed_update_task.add_done_callback(self._background_feed_update_tasks.discard)
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def close(self) -> None:
+        # Telegram уже получил 200 на эти апдейты - дожидаемся их обработки до закрытия сессии бота
+        for _ in range(self.max_in_flight):
+            await self.in_flight.acquire()
+        await super().close()
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    """Метрики Prometheus на том же сервере, что и webhook"""
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+async def set_webhook(bot: Bot, dispatcher: Dispatcher):
+    # Апдейты, пришедшие во время перезапуска, не сбрасываем
+    await bot.set_webhook(
+        url=f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        max_connections=min(WEBHOOK_MAX_IN_FLIGHT, 100),
+        allowed_updates=dispatcher.resolve_used_update_types(),
+        drop_pending_updates=False,
+    )
+    logger.info(f"(MAIN)\t\t Webhook set to {WEBHOOK_BASE_URL}{WEBHOOK_PATH}")
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    """Запуск бота в режиме webhook (aiohttp сервер) до SIGINT / SIGTERM"""
+    app = web.Application()
+    BoundedRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET,
+        max_in_flight=WEBHOOK_MAX_IN_FLIGHT,
+    ).register(app, path=WEBHOOK_PATH)
+    app.router.add_get("/metrics", metrics_handler)
+
+    dp.startup.register(set_webhook)
+    setup_application(app, dp, bot=bot)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host=WEBAPP_HOST, port=WEBAPP_PORT).start()
+        logger.info(f"(MAIN)\t\t Webhook server started on {WEBAPP_HOST}:{WEBAPP_PORT}")
+        await stop_event.wait()
+    finally:
+        # Вызывает shutdown диспетчера (on_shutdown) и закрывает сессию бота
+        await runner.cleanup()
@@ -1,3 +1,5 @@
 # from .sqlite3 import Database
-from .postrgeSQL import Database
-from .redisCRUD import Redis
\ No newline at end of file
+from .postrgeSQL import Database, UserState
+from .redisCRUD import Redis
+from .usage import UsageAggregator
+from .entitlements import EntitlementCache
@@ -0,0 +1,148 @@
+import asyncio
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from src.database.postrgeSQL import Database, UserState
+from src.database.redisCRUD import Redis
+from src.database.usage import UsageAggregator
+from src.config import (
+    ENTITLEMENT_CACHE_SIZE,
+    ENTITLEMENT_LOCAL_TTL,
+    ENTITLEMENT_REDIS_TTL,
+)
+from src.logger import logger
+
+
+class EntitlementCache:
+    """
+    Кэш статуса подписки и пробного периода пользователя.
+    Уровни: локальный LRU -> Redis -> PostgreSQL.
+
+    Хранится дата окончания подписки и количество запросов, поэтому
+    проверка подписки/триала выполняется локально по часам (UserState).
+    Запись сбрасывается при оплате, остальные реплики бота
+    узнают об этом через Redis Pub/Sub. Сброс меняет поколение записи - статус,
+    прочитанный из БД до сброса, в кэш уже не попадет.
+    """
+    INVALIDATE_CHANNEL = "entitlements:invalidate"
+
+    def __init__(self, db: Database, redis: Redis, usage: UsageAggregator = None):
+        self.db = db
+        self.redis = redis
+        self.usage = usage
+        self.local: OrderedDict[int, tuple[UserState, float]] = OrderedDict()
+        self.listen_task = None
+
+    @classmethod
+    async def create(cls, db: Database, redis: Redis, usage: UsageAggregator = None):
+        self = cls(db, redis, usage)
+        self.listen_task = asyncio.create_task(self.listen_invalidations())
+        return self
+
+    async def close(self):
+        if self.listen_task:
+            self.listen_task.cancel()
+            try:
+                await self.listen_task
+            except asyncio.CancelledError:
+                pass
+        self.local.clear()
+        logger.info("(Entitlements)\t Cache closed")
+
+    async def get(self, telegram_id: int) -> UserState | None:
+        """
+        Получить UserState пользователя.
+        None - пользователя нет в базе данных.
+        """
+        state = self._get_local(telegram_id)
+        if state is not None:
+            return state
+
+        entitlement = await self.redis.get_entitlement(telegram_id)
+        if entitlement:
+            sub_exp = entitlement.get("sub_exp")
+            state = UserState(
+                telegram_id=telegram_id,
+                num_requests=int(entitlement.get("num_requests", 0)),
+                sub_expiration_date=datetime.fromtimestamp(float(sub_exp), tz=timezone.utc) if sub_exp else None,
+            )
+            self._set_local(state)
+            return state
+
+        generation = await self.redis.get_entitlement_generation(telegram_id)
+        state = await self.db.get_user_state(telegram_id)
+        if state is not None:
+            if self.usage is not None:
+                # Запросы, которые еще не записаны в БД (write-behind)
+                state.num_requests += self.usage.pending_requests(telegram_id)
+            await self.set(state, generation=generation)
+        return state
+
+    async def set(self, state: UserState, generation: int | None = None):
+        """
+        Положить состояние пользователя в оба уровня кэша.
+        generation - поколение записи на момент чтения из БД (None - состояние заведомо актуально)
+        """
+        sub_exp = state.sub_expiration_date.timestamp() if state.sub_expiration_date else None
+        written = await self.redis.set_entitlement(
+            state.telegram_id,
+            sub_exp=sub_exp,
+            num_requests=state.num_requests,
+            ttl=ENTITLEMENT_REDIS_TTL,
+            generation=generation,
+        )
+        if written is False:
+            # Пока читали из БД, кэш сбросили (оплата) - прочитанное состояние могло устареть
+            return
+        self._set_local(state)
+
+    async def add_requests(self, telegram_id: int, amount: int = 1):
+        """Учесть новые запросы пользователя (для проверки пробного периода)"""
+        cached = self.local.get(telegram_id)
+        if cached is not None:
+            cached[0].num_requests += amount
+        await self.redis.incr_entitlement_requests(telegram_id, amount)
+
+    async def invalidate(self, telegram_id: int):
+        """Сбросить состояние пользователя (например, после оплаты) на всех репликах"""
+        self.local.pop(telegram_id, None)
+        await self.redis.delete_entitlement(telegram_id, ttl=ENTITLEMENT_REDIS_TTL)
+        await self.redis.publish(self.INVALIDATE_CHANNEL, telegram_id)
+        logger.debug(f"(Entitlements)\t User {telegram_id} invalidated")
+
+    async def listen_invalidations(self):
+        """Слушаем уведомления о сбросе кэша от других реплик"""
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(self.INVALIDATE_CHANNEL)
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self.local.pop(int(message["data"]), None)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"(Entitlements)\t Invalidation listener error: {e}")
+                # Пока нет подписки, локальному кэшу верить нельзя
+                self.local.clear()
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    def _get_local(self, telegram_id: int) -> UserState | None:
+        cached = self.local.get(telegram_id)
+        if cached is None:
+            return None
+        state, cached_at = cached
+        if time.monotonic() - cached_at > ENTITLEMENT_LOCAL_TTL:
+            del self.local[telegram_id]
+            return None
+        self.local.move_to_end(telegram_id)
+        return state
+
+    def _set_local(self, state: UserState):
+        self.local[state.telegram_id] = (state, time.monotonic())
+        self.local.move_to_end(state.telegram_id)
+        while len(self.local) > ENTITLEMENT_CACHE_SIZE:
+            self.local.popitem(last=False)
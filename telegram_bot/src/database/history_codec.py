@@ -0,0 +1,61 @@
+"""
+Компактный формат записи истории диалога в Redis.
+
+Версия 1:
+    byte 0      - версия формата (0x01)
+    byte 1      - роль (ROLE_CODES)
+    byte 2      - сжатие (0 - нет, 1 - zlib)
+    bytes 3..   - текст сообщения (UTF-8, возможно сжатый)
+
+Старые записи - JSON ({"role": ..., "content": ...}), начинаются с "{" и читаются как раньше.
+"""
+import json
+import zlib
+
+FORMAT_V1 = 0x01
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+
+ROLE_CODES = {
+    "system": 0,
+    "user": 1,
+    "assistant": 2,
+}
+CODE_ROLES = {code: role for role, code in ROLE_CODES.items()}
+
+# Текст короче этого размера не сжимаем - выигрыш меньше накладных расходов
+COMPRESS_MIN_BYTES = 512
+
+
+def encode_history_entry(message: dict, compress_min_bytes: int = COMPRESS_MIN_BYTES) -> bytes:
+    """{'role': ..., 'content': ...} -> bytes"""
+    role = message["role"]
+    if role not in ROLE_CODES:
+        # Неизвестная роль - оставляем JSON
+        return json.dumps(message).encode("utf-8")
+
+    content = message["content"].encode("utf-8")
+    compression = COMPRESSION_NONE
+    if len(content) >= compress_min_bytes:
+        compressed = zlib.compress(content, 6)
+        if len(compressed) < len(content):
+            content, compression = compressed, COMPRESSION_ZLIB
+
+    return bytes((FORMAT_V1, ROLE_CODES[role], compression)) + content
+
+
+def decode_history_entry(entry: bytes | str) -> dict:
+    """bytes (новый формат или старый JSON) -> {'role': ..., 'content': ...}"""
+    if isinstance(entry, str):
+        entry = entry.encode("utf-8")
+
+    if not entry or entry[0] != FORMAT_V1:
+        # Старый формат (JSON)
+        return json.loads(entry)
+
+    role = CODE_ROLES[entry[1]]
+    content = entry[3:]
+    if entry[2] == COMPRESSION_ZLIB:
+        content = zlib.decompress(content)
+    return {"role": role, "content": content.decode("utf-8")}
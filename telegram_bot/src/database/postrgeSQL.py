@@ -6,11 +6,13 @@ from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy import update
 
 from src.logger import logger
+from src.prometheus_metrics import timed
 
 from src.config import SUBSCRIPTION_DURATION_MONTHS, TRIAL_PERIOD_NUM_REQ
 
 from dateutil.relativedelta import relativedelta
-from datetime import datetime
+from dataclasses import dataclass
+from datetime import datetime, timezone
 import pytz
 
 SRV_TZ = pytz.timezone("Europe/Moscow")
@@ -18,6 +20,7 @@ SRV_TZ = pytz.timezone("Europe/Moscow")
 class Base(DeclarativeBase): pass
 
 def handle_db_errors(func):
+    func = timed("postgres")(func)
     async def wrapper(*args, **kwargs):
         try:
             return await func(*args, **kwargs)
@@ -69,6 +72,33 @@ class Error(Base):
     traceback = Column(String())
     is_resolved = Column(Boolean, default=False)
 
+@dataclass
+class UserState:
+    """
+    Снимок состояния пользователя, загружаемый одним запросом на апдейт.
+    Все проверки (триал, подписка) в middleware читают его вместо отдельных запросов к БД.
+    """
+    telegram_id: int
+    num_requests: int = 0
+    sub_expiration_date: datetime | None = None
+
+    @property
+    def is_subscription_active(self) -> bool:
+        """sub_expiration_date is not NULL и текущая дата меньше sub_expiration_date"""
+        if self.sub_expiration_date is None:
+            return False
+        return self.sub_expiration_date > datetime.now(timezone.utc)
+
+    @property
+    def is_trial(self) -> bool:
+        """Пробный период (num_requests < TRIAL_PERIOD_NUM_REQ)"""
+        return self.num_requests < TRIAL_PERIOD_NUM_REQ
+
+    @property
+    def trial_requests_remain(self) -> int:
+        return max(TRIAL_PERIOD_NUM_REQ - self.num_requests, 0)
+
+
 class Database:
     def __init__(self, db_url: str):
         try:
@@ -129,32 +159,81 @@ class Database:
             )
             return result.scalar()
     
-    @handle_db_errors
-    async def increment_user_requests(self, telegram_id: int):
-        """Увеличить счетчик запросов пользователя."""
+    @timed("postgres")
+    async def get_user_state(self, telegram_id: int) -> UserState | None:
+        """
+        Получить снимок состояния пользователя одним запросом.
+        None - пользователя нет в базе данных.
+        Ошибки БД пробрасываются (не handle_db_errors): иначе ошибка неотличима от нового пользователя
+        """
         async with self.SessionLocal() as session:
-            async with session.begin():
-                user = await session.get(User, telegram_id)
-                user.num_requests += 1
-                logger.debug(f"(POSTGRE)\t User {telegram_id} requests incremented")
+            result = await session.execute(
+                text("""
+                    SELECT num_requests, sub_expiration_date
+                    FROM users
+                    WHERE telegram_id = :telegram_id
+                """),
+                {"telegram_id": telegram_id},
+            )
+            row = result.first()
+            if row is None:
+                return None
+            return UserState(
+                telegram_id=telegram_id,
+                num_requests=row.num_requests or 0,
+                sub_expiration_date=row.sub_expiration_date,
+            )
 
     @handle_db_errors
-    async def add_user_input_tokens(self, telegram_id: int, tokens: int):
-        """Добавить входные токены пользователю."""
+    async def record_usage(self, telegram_id: int, *, 
+                           requests: int = 0, 
+                           input_tokens: int = 0, 
+                           output_tokens: int = 0) -> UserState | None:
+        """
+        Атомарно (на стороне сервера) увеличить счетчики пользователя.
+        Возвращает состояние пользователя после обновления - для проверки триала/подписки
+        без повторного чтения.
+        """
         async with self.SessionLocal() as session:
             async with session.begin():
-                user = await session.get(User, telegram_id)
-                user.num_input_tokens += tokens
-                logger.debug(f"(POSTGRE)\t User {telegram_id} input tokens ({tokens}) added")
+                result = await session.execute(
+                    text("""
+                        UPDATE users SET
+                            num_requests = COALESCE(num_requests, 0) + :requests,
+                            num_input_tokens = COALESCE(num_input_tokens, 0) + :input_tokens,
+                            num_output_tokens = COALESCE(num_output_tokens, 0) + :output_tokens,
+                            last_req_date = CASE WHEN :requests > 0 THEN now() ELSE last_req_date END
+                        WHERE telegram_id = :telegram_id
+                        RETURNING num_requests, sub_expiration_date
+                    """),
+                    {
+                        "telegram_id": telegram_id,
+                        "requests": requests,
+                        "input_tokens": input_tokens,
+                        "output_tokens": output_tokens,
+                    },
+                )
+                row = result.first()
+                if row is None:
+                    return None
+                logger.debug(f"(POSTGRE)\t User {telegram_id} usage recorded")
+                return UserState(
+                    telegram_id=telegram_id,
+                    num_requests=row.num_requests,
+                    sub_expiration_date=row.sub_expiration_date,
+                )
 
-    @handle_db_errors
-    async def add_user_output_tokens(self, telegram_id: int, tokens: int):
+    async def increment_user_requests(self, telegram_id: int) -> UserState | None:
+        """Увеличить счетчик запросов пользователя."""
+        return await self.record_usage(telegram_id, requests=1)
+
+    async def add_user_input_tokens(self, telegram_id: int, tokens: int) -> UserState | None:
+        """Добавить входные токены пользователю."""
+        return await self.record_usage(telegram_id, input_tokens=tokens)
+
+    async def add_user_output_tokens(self, telegram_id: int, tokens: int) -> UserState | None:
         """Добавить выходные токены пользователю."""
-        async with self.SessionLocal() as session:
-            async with session.begin():
-                user = await session.get(User, telegram_id)
-                user.num_output_tokens += tokens
-                logger.debug(f"(POSTGRE)\t User {telegram_id} output tokens ({tokens}) added")
+        return await self.record_usage(telegram_id, output_tokens=tokens)
     
     @handle_db_errors
     async def update_last_req_date(self, telegram_id: int):
@@ -170,6 +249,45 @@ class Database:
                 await session.execute(stmt)
                 logger.debug("(POSTGRE)\t Updated last_req_date for user_id: %s", telegram_id)
 
+    @handle_db_errors
+    async def apply_usage_batch(self, rows: list[tuple[int, int, int, int, datetime | None]]):
+        """
+        Применить накопленные счетчики пачкой одним UPDATE ... FROM (VALUES ...).
+        rows: (telegram_id, num_requests, num_input_tokens, num_output_tokens, last_req_date)
+        """
+        batch_size = 1000  # Ограничение asyncpg на количество параметров в запросе
+        async with self.SessionLocal() as session:
+            async with session.begin():
+                for offset in range(0, len(rows), batch_size):
+                    values, params = [], {}
+                    for i, (telegram_id, requests, input_tokens, output_tokens, last_req_date) in enumerate(rows[offset:offset + batch_size]):
+                        values.append(
+                            f"(CAST(:id_{i} AS BIGINT), CAST(:req_{i} AS BIGINT), "
+                            f"CAST(:in_{i} AS BIGINT), CAST(:out_{i} AS BIGINT), CAST(:date_{i} AS TIMESTAMPTZ))"
+                        )
+                        params.update({
+                            f"id_{i}": telegram_id,
+                            f"req_{i}": requests,
+                            f"in_{i}": input_tokens,
+                            f"out_{i}": output_tokens,
+                            f"date_{i}": last_req_date,
+                        })
+                    await session.execute(
+                        text(f"""
+                            UPDATE users AS u SET
+                                num_requests = COALESCE(u.num_requests, 0) + v.num_requests,
+                                num_input_tokens = COALESCE(u.num_input_tokens, 0) + v.num_input_tokens,
+                                num_output_tokens = COALESCE(u.num_output_tokens, 0) + v.num_output_tokens,
+                                last_req_date = COALESCE(v.last_req_date, u.last_req_date)
+                            FROM (VALUES {", ".join(values)})
+                                AS v(telegram_id, num_requests, num_input_tokens, num_output_tokens, last_req_date)
+                            WHERE u.telegram_id = v.telegram_id
+                        """),
+                        params,
+                    )
+                logger.debug(f"(POSTGRE)\t Usage batch applied for {len(rows)} users")
+                return True
+
     @handle_db_errors
     async def get_num_requests(self, telegram_id: int) -> int:
         """Получить количество запросов пользователя."""
@@ -1,10 +1,21 @@
-import json
 import redis.asyncio as aioredis
+import json
 import asyncio
+import time
 from src.logger import logger
+from src.tokens import count_message_tokens
+from src.config import (
+    HISTORY_MAX_ENTRIES, 
+    HISTORY_ENTRY_MAX_BYTES, 
+    HISTORY_COMPRESS_MIN_BYTES, 
+    REDIS_MAINTENANCE_TIME_BUDGET
+)
+from src.prometheus_metrics import REDIS_UNLINKED_KEYS, timed
+from src.database.history_codec import encode_history_entry, decode_history_entry
 import sys
 
 def handle_redis_errors(func):
+    func = timed("redis")(func)
     async def wrapper(*args, **kwargs):
         try:
             return await func(*args, **kwargs)
@@ -13,15 +24,66 @@ def handle_redis_errors(func):
             return None
     return wrapper
 
+class WaiterRegistry:
+    """
+    Локальные подписчики на смену статуса запроса пользователя (active / inactive).
+    Уведомления приходят из Redis Pub/Sub, в т.ч. от других реплик.
+    """
+    def __init__(self):
+        self.listeners: list = []
+        self.resync_listeners: list = []
+
+    def add_listener(self, callback, *, resync=None):
+        """
+        callback(user_id, state) вызывается при каждом уведомлении,
+        resync() - после переподключения подписки (уведомления могли потеряться)
+        """
+        self.listeners.append(callback)
+        if resync is not None:
+            self.resync_listeners.append(resync)
+
+    def remove_listener(self, callback, *, resync=None):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+        if resync in self.resync_listeners:
+            self.resync_listeners.remove(resync)
+
+    def notify(self, user_id, state: str):
+        for callback in self.listeners:
+            try:
+                callback(int(user_id), state)
+            except Exception as e:
+                logger.error(f"(Redis)\t Error in user processing listener: {e}")
+
+    def notify_all(self):
+        """Подписка восстановлена - подписчики сами перепроверяют статус запросов"""
+        for resync in self.resync_listeners:
+            try:
+                resync()
+            except Exception as e:
+                logger.error(f"(Redis)\t Error in user processing resync: {e}")
+
+
 class Redis:
+    # Канал уведомлений о смене статуса запроса пользователя ("{user_id}:active" / "{user_id}:inactive")
+    USER_PROCESSING_CHANNEL = "events:user_processing"
+
     def __init__(self, redis_host, redis_port):
         self.redis = aioredis.from_url(f"redis://{redis_host}:{redis_port}", db=0,decode_responses=True)
+        # История хранится в бинарном формате (history_codec) - отдельный клиент без декодирования
+        self.redis_bin = aioredis.from_url(f"redis://{redis_host}:{redis_port}", db=0, decode_responses=False)
+        self.waiters = WaiterRegistry()
+        self.listen_task = None
+        self._register_lease_scripts()
+        self._register_history_scripts()
+        self._register_response_cache_scripts()
         self.check_task = asyncio.create_task(self.check_connection())
 
     @classmethod
     async def create(cls, redis_host, redis_port):
         self = cls(redis_host, redis_port)
         await self.check_task  # Дожидаемся завершения задачи
+        self.listen_task = asyncio.create_task(self.listen_user_processing())
         return self
 
     async def check_connection(self):
@@ -34,37 +96,258 @@ class Redis:
 
     @handle_redis_errors
     async def close(self):
+        if self.listen_task:
+            self.listen_task.cancel()
+            try:
+                await self.listen_task
+            except asyncio.CancelledError:
+                pass
         await self.redis.aclose()
+        await self.redis_bin.aclose()
         logger.info(f"(Redis)\t Redis connection closed")
 
+    def _register_history_scripts(self):
+        # KEYS[1] - history:{id}, KEYS[2] - history_tokens:{id}, ARGV[1] - бюджет токенов,
+        # ARGV[2] - '1': старые записи без количества токенов (в начале списка) не брать.
+        # Иначе, если такие записи есть, возвращается их количество - их нужно досчитать (backfill)
+        self._history_window_script = self.redis_bin.register_script("""
+            local budget = tonumber(ARGV[1])
+            local n = redis.call('LLEN', KEYS[1])
+            if n == 0 then return {} end
+            local counts = redis.call('LRANGE', KEYS[2], -n, -1)
+            local offset = n - #counts
+            if offset > 0 and ARGV[2] ~= '1' then
+                return offset
+            end
+            local total = 0
+            for i = #counts, 1, -1 do
+                total = total + tonumber(counts[i])
+                if total > budget then
+                    return redis.call('LRANGE', KEYS[1], offset + i, -1)
+                end
+            end
+            return redis.call('LRANGE', KEYS[1], offset, -1)
+        """)
+        # KEYS[1] - history:{id}, KEYS[2] - history_tokens:{id}, KEYS[3] - history_version:{id}
+        # ARGV[1] - версия истории при чтении, ARGV[2..] - количества токенов первых записей истории
+        self._backfill_history_tokens_script = self.redis_bin.register_script("""
+            local version = redis.call('GET', KEYS[3]) or '0'
+            if version ~= ARGV[1] then
+                return 0
+            end
+            if redis.call('LLEN', KEYS[1]) - redis.call('LLEN', KEYS[2]) ~= #ARGV - 1 then
+                return 0
+            end
+            for i = #ARGV, 2, -1 do
+                redis.call('LPUSH', KEYS[2], ARGV[i])
+            end
+            return 1
+        """)
+        # KEYS[1] - history:{id}, KEYS[2] - history_tokens:{id}, KEYS[3] - history_version:{id},
+        # KEYS[4] - user_processing:{id}. ARGV[1] - fencing-токен аренды ('' - без проверки),
+        # ARGV[2] - максимум записей, ARGV[3] - TTL, ARGV[4] - n, далее n записей и n количеств токенов.
+        # Версия истории - защита сжатия истории от гонки с новыми сообщениями
+        self._append_history_script = self.redis_bin.register_script("""
+            if ARGV[1] ~= '' and redis.call('GET', KEYS[4]) ~= ARGV[1] then
+                return -1
+            end
+            local max_entries = tonumber(ARGV[2])
+            local n = tonumber(ARGV[4])
+            local history_len = 0
+            for i = 1, n do
+                history_len = redis.call('RPUSH', KEYS[1], ARGV[4 + i])
+                redis.call('RPUSH', KEYS[2], ARGV[4 + n + i])
+            end
+            redis.call('LTRIM', KEYS[1], -max_entries, -1)
+            redis.call('LTRIM', KEYS[2], -max_entries, -1)
+            redis.call('INCR', KEYS[3])
+            for i = 1, 3 do
+                redis.call('EXPIRE', KEYS[i], ARGV[3])
+            end
+            return history_len
+        """)
+        # KEYS[1] - history:{id}, KEYS[2] - history_tokens:{id}, KEYS[3] - history_version:{id}
+        # ARGV[1] - версия истории при чтении, ARGV[2] - сколько сообщений заменить, 
+        # ARGV[3] - summary, ARGV[4] - токены summary
+        self._replace_history_head_script = self.redis_bin.register_script("""
+            local version = redis.call('GET', KEYS[3]) or '0'
+            if version ~= ARGV[1] then
+                return 0
+            end
+            local count = tonumber(ARGV[2])
+            local history_len = redis.call('LLEN', KEYS[1])
+            local tokens_drop = redis.call('LLEN', KEYS[2]) - (history_len - count)
+            redis.call('LTRIM', KEYS[1], count, -1)
+            redis.call('LPUSH', KEYS[1], ARGV[3])
+            if tokens_drop > 0 then
+                redis.call('LTRIM', KEYS[2], tokens_drop, -1)
+            end
+            redis.call('LPUSH', KEYS[2], ARGV[4])
+            redis.call('INCR', KEYS[3])
+            return 1
+        """)
+
     @handle_redis_errors
     async def get_history(self, user_id):
         """Получить историю сообщений для пользователя"""
-        history = await self.redis.lrange(f"history:{user_id}", 0, -1)
-        return [json.loads(item) for item in history] if history else []
+        history = await self.redis_bin.lrange(f"history:{user_id}", 0, -1)
+        return [decode_history_entry(item) for item in history] if history else []
 
     @handle_redis_errors
-    async def append_to_history(self, user_id, messages: list):
-        """Добавить сообщение в историю (без перезаписи)"""
-        await self.redis.rpush(f"history:{user_id}", *(json.dumps(message) for message in messages))
-        await self.set_expiration(key=f"history:{user_id}", days=3)
+    async def get_history_length(self, user_id) -> int:
+        """Количество сообщений в истории (LLEN, без загрузки самих сообщений)"""
+        return await self.redis.llen(f"history:{user_id}")
+
+    @handle_redis_errors
+    async def get_history_window(self, user_id, token_budget: int) -> list[dict]:
+        """
+        Получить последние сообщения истории, которые помещаются в token_budget токенов.
+        Окно считается на стороне Redis по сохраненным количествам токенов (history_tokens),
+        без повторной токенизации прошлых сообщений. Окно начинается с сообщения пользователя.
+        Для старых записей без количества токенов оно считается один раз и сохраняется.
+        """
+        keys = [f"history:{user_id}", f"history_tokens:{user_id}"]
+        history = await self._history_window_script(keys=keys, args=[token_budget, 0])
+        if isinstance(history, int):
+            await self._backfill_history_tokens(user_id, history)
+            # Если досчитать не удалось (история изменилась) - старые записи не берем
+            history = await self._history_window_script(keys=keys, args=[token_budget, 1])
+        messages = [decode_history_entry(item) for item in history] if history else []
+        # Не начинаем окно с ответа ассистента (без вопроса, на который он отвечал)
+        start = 0
+        while start < len(messages) and messages[start]["role"] == "assistant":
+            start += 1
+        return messages[start:]
+
+    async def _backfill_history_tokens(self, user_id, missing: int):
+        """Посчитать токены missing первых записей истории (записанных до history_tokens)"""
+        async with self.redis_bin.pipeline(transaction=True) as pipe:
+            pipe.get(f"history_version:{user_id}")
+            pipe.lrange(f"history:{user_id}", 0, missing - 1)
+            version, head = await pipe.execute()
+        counts = [count_message_tokens(decode_history_entry(item)) for item in head]
+        return await self._backfill_history_tokens_script(
+            keys=[f"history:{user_id}", f"history_tokens:{user_id}", f"history_version:{user_id}"],
+            args=[int(version or 0), *counts],
+        )
+
+    @handle_redis_errors
+    async def append_to_history(self, user_id, messages: list, 
+                                token_counts: list[int] | None = None, 
+                                lease_token: int | None = None):
+        """
+        Добавить сообщение в историю (без перезаписи). Возвращает длину истории.
+        token_counts - количество токенов каждого сообщения (если не задано - считаются локально)
+        lease_token - fencing-токен аренды запроса: запись выполняется, только если аренда все еще наша
+        (иначе None - запрос, потерявший аренду, не перемешивает историю с новым владельцем).
+        Один скрипт: RPUSH + LTRIM до HISTORY_MAX_ENTRIES + EXPIRE.
+        Сообщения длиннее HISTORY_ENTRY_MAX_BYTES обрезаются.
+        """
+        if token_counts is None:
+            token_counts = [None] * len(messages)
+        entries, counts = [], []
+        for message, tokens in zip(messages, token_counts):
+            message, truncated = self._cap_history_entry(message)
+            entries.append(encode_history_entry(message, HISTORY_COMPRESS_MIN_BYTES))
+            counts.append(count_message_tokens(message) if truncated or tokens is None else tokens)
+
+        ttl = 3 * 24 * 60 * 60  # 3 дня
+        history_len = await self._append_history_script(
+            keys=[
+                f"history:{user_id}", f"history_tokens:{user_id}", 
+                f"history_version:{user_id}", f"user_processing:{user_id}"
+            ],
+            args=[lease_token or "", HISTORY_MAX_ENTRIES, ttl, len(entries), *entries, *counts],
+        )
+        if history_len == -1:
+            logger.warning(f"(Redis)\t Lease of user {user_id} (token {lease_token}) lost, history not saved")
+            return None
         logger.debug(f"(Redis)\t Added: messages to user with id {user_id}")
+        return min(history_len, HISTORY_MAX_ENTRIES)
+
+    @staticmethod
+    def _cap_history_entry(message: dict) -> tuple[dict, bool]:
+        """Обрезать текст сообщения до HISTORY_ENTRY_MAX_BYTES байт (UTF-8)"""
+        content: str = message["content"]
+        if len(content) * 4 <= HISTORY_ENTRY_MAX_BYTES:
+            return message, False  # Точно помещается (не больше 4 байт на символ)
+        encoded = content.encode("utf-8")
+        if len(encoded) <= HISTORY_ENTRY_MAX_BYTES:
+            return message, False
+        content = encoded[:HISTORY_ENTRY_MAX_BYTES - 3].decode("utf-8", errors="ignore") + "…"
+        return {**message, "content": content}, True
+
+    @handle_redis_errors
+    async def get_history_head(self, user_id, keep: int) -> tuple[int, list[dict]]:
+        """
+        Получить версию истории и все сообщения, кроме последних keep (для сжатия).
+        """
+        async with self.redis_bin.pipeline(transaction=True) as pipe:
+            pipe.get(f"history_version:{user_id}")
+            pipe.lrange(f"history:{user_id}", 0, -keep - 1)
+            version, head = await pipe.execute()
+        return int(version or 0), [decode_history_entry(item) for item in head]
+
+    @handle_redis_errors
+    async def replace_history_head(self, user_id, version: int, count: int, summary: dict, summary_tokens: int) -> bool:
+        """
+        Заменить первые count сообщений истории на summary,
+        только если история не менялась с момента чтения (version).
+        """
+        return bool(await self._replace_history_head_script(
+            keys=[f"history:{user_id}", f"history_tokens:{user_id}", f"history_version:{user_id}"],
+            args=[version, count, encode_history_entry(summary, HISTORY_COMPRESS_MIN_BYTES), summary_tokens],
+        ))
 
     @handle_redis_errors
     async def clear_user_history(self, user_id):
         """Очистить историю сообщений для пользователя"""
-        await self.redis.delete(f"history:{user_id}")
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(f"history:{user_id}", f"history_tokens:{user_id}")
+            # Версию не удаляем, а увеличиваем: сжатие, прочитавшее историю до очистки,
+            # не должно совпасть по версии с новой историей
+            pipe.incr(f"history_version:{user_id}")
+            pipe.expire(f"history_version:{user_id}", 3 * 24 * 60 * 60)
+            await pipe.execute()
         logger.debug(f"(Redis)\t History user {user_id} cleared")
 
     @handle_redis_errors
     async def clear_all_history(self):
         """Очистить всю историю сообщений"""
-        # Ищем все ключи по паттерну
-        keys = await self.redis.keys("history:*")
-        # Удаляем
-        await self.redis.delete(*keys)
+        deleted = 0
+        # Версии историй остаются (истекают по TTL) - иначе возможна гонка со сжатием истории
+        for pattern in ("history:*", "history_tokens:*"):
+            deleted += await self.unlink_by_pattern(pattern)
         # Логируем
-        logger.debug(f"(Redis)\t All history cleared")
+        logger.debug(f"(Redis)\t All history cleared ({deleted} keys)")
+
+    async def unlink_by_pattern(self, pattern: str, *, 
+                                batch_size: int = 500, 
+                                time_budget: float = REDIS_MAINTENANCE_TIME_BUDGET) -> int:
+        """
+        Удалить ключи по паттерну без блокировки Redis:
+        SCAN небольшими порциями + UNLINK пачками (память освобождается в фоне).
+        Останавливается по истечении time_budget секунд. Возвращает количество удаленных ключей.
+        """
+        deadline = time.monotonic() + time_budget
+        deleted = 0
+        batch = []
+        cursor = 0
+        while True:
+            # Бюджет проверяется на каждой странице SCAN - совпадений может не быть на многих страницах подряд
+            cursor, keys = await self.redis.scan(cursor=cursor, match=pattern, count=batch_size)
+            batch.extend(keys)
+            finished = cursor == 0
+            out_of_time = not finished and time.monotonic() > deadline
+            if batch and (len(batch) >= batch_size or finished or out_of_time):
+                deleted += await self.redis.unlink(*batch)
+                REDIS_UNLINKED_KEYS.labels(pattern=pattern).inc(len(batch))
+                batch = []
+            if finished:
+                return deleted
+            if out_of_time:
+                logger.warning(f"(Redis)\t Time budget exceeded while deleting {pattern} ({deleted} keys deleted)")
+                return deleted
 
     @handle_redis_errors
     async def set_expiration(self, key: str, *, days=0.1):
@@ -72,30 +355,209 @@ class Redis:
         seconds = days * 24 * 60 * 60
         await self.redis.expire(key, seconds)
     
-    @handle_redis_errors
-    async def set_user_req_active(self, user_id):
-        """Установить флаг user_processing:{user_id} = 1"""
-        await self.redis.set(f"user_processing:{user_id}", value=1, ex=60) # expiration 120 sec
-        # logger.debug(f"(Redis)\t User with id {user_id} is processing")
-    
     @handle_redis_errors
     async def is_user_waiting(self, user_id):
         """Проверить, активен ли запрос пользователя"""
         # logger.debug(f"(Redis)\t User with id {user_id} is waiting")
         return await self.redis.exists(f"user_processing:{user_id}")
     
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # Lease (атомарная аренда обработки запроса пользователя)
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _register_lease_scripts(self):
+        # KEYS[1] - user_processing:{id}, KEYS[2] - счетчик fencing-токенов
+        self._acquire_lease_script = self.redis.register_script("""
+            if redis.call('EXISTS', KEYS[1]) == 1 then
+                return 0
+            end
+            local token = redis.call('INCR', KEYS[2])
+            redis.call('SET', KEYS[1], token, 'PX', ARGV[1])
+            redis.call('PUBLISH', ARGV[2], ARGV[3])
+            return token
+        """)
+        self._renew_lease_script = self.redis.register_script("""
+            if redis.call('GET', KEYS[1]) == ARGV[1] then
+                return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+            end
+            return 0
+        """)
+        self._release_lease_script = self.redis.register_script("""
+            if redis.call('GET', KEYS[1]) == ARGV[1] then
+                redis.call('DEL', KEYS[1])
+                redis.call('PUBLISH', ARGV[2], ARGV[3])
+                return 1
+            end
+            return 0
+        """)
+
     @handle_redis_errors
-    async def set_user_req_inactive(self, user_id):
-        """Установить флаг user_processing:{user_id} = 0"""
-        await self.redis.delete(f"user_processing:{user_id}")
-        # logger.debug(f"(Redis)\t User {user_id} requests set to inactive")
+    async def acquire_lease(self, user_id, ttl_ms: int) -> int:
+        """
+        Атомарно занять обработку запроса пользователя (SET NX PX).
+        Возвращает fencing-токен, 0 - запрос пользователя уже обрабатывается.
+        """
+        token = await self._acquire_lease_script(
+            keys=[f"user_processing:{user_id}", "fence:user_processing"],
+            args=[ttl_ms, self.USER_PROCESSING_CHANNEL, f"{user_id}:active"],
+        )
+        return int(token)
 
     @handle_redis_errors
-    async def clear_all_waitings(self):
-        """Очистить все флаги активности запроса всех пользователей"""
-        # Ищем все ключи по паттерну
-        keys = await self.redis.keys("user_processing:*")
-        # Удаляем
-        await self.redis.delete(*keys)
-        # Логируем
-        logger.debug(f"(Redis)\t All waitings cleared ")
+    async def renew_lease(self, user_id, token: int, ttl_ms: int) -> bool:
+        """Продлить аренду, если она все еще наша"""
+        return bool(await self._renew_lease_script(
+            keys=[f"user_processing:{user_id}"],
+            args=[token, ttl_ms],
+        ))
+
+    @handle_redis_errors
+    async def release_lease(self, user_id, token: int) -> bool:
+        """Освободить аренду (compare-and-delete), если она все еще наша"""
+        return bool(await self._release_lease_script(
+            keys=[f"user_processing:{user_id}"],
+            args=[token, self.USER_PROCESSING_CHANNEL, f"{user_id}:inactive"],
+        ))
+
+    async def keep_lease(self, user_id, token: int, ttl_ms: int):
+        """Продлевать аренду, пока выполняется запрос (запускается задачей)"""
+        while True:
+            await asyncio.sleep(ttl_ms / 3 / 1000)
+            if not await self.renew_lease(user_id, token, ttl_ms):
+                logger.warning(f"(Redis)\t Lease of user {user_id} (token {token}) lost")
+                return
+
+    async def listen_user_processing(self):
+        """Слушаем уведомления о смене статуса запросов (в т.ч. от других реплик)"""
+        reconnect = False
+        while True:
+            pubsub = self.pubsub()
+            try:
+                await pubsub.subscribe(self.USER_PROCESSING_CHANNEL)
+                if reconnect:
+                    # Пока подписки не было, уведомления могли потеряться - пусть перепроверят статус
+                    self.waiters.notify_all()
+                    reconnect = False
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        user_id, state = message["data"].split(":")
+                        self.waiters.notify(user_id, state)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"(Redis)\t User processing listener error: {e}")
+                reconnect = True
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # Entitlements (кэш статуса подписки / пробного периода)
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    @handle_redis_errors
+    async def get_entitlement(self, user_id) -> dict | None:
+        """Получить закэшированный статус пользователя {sub_exp, num_requests}"""
+        entitlement = await self.redis.hgetall(f"entitlement:{user_id}")
+        return entitlement or None
+
+    @handle_redis_errors
+    async def get_entitlement_generation(self, user_id) -> int:
+        """Поколение статуса пользователя (увеличивается при каждом сбросе кэша)"""
+        return int(await self.redis.get(f"entitlement_gen:{user_id}") or 0)
+
+    @handle_redis_errors
+    async def set_entitlement(self, user_id, sub_exp: float | None, num_requests: int, ttl: int,
+                              generation: int | None = None) -> bool:
+        """
+        Сохранить статус пользователя (sub_exp - unix timestamp окончания подписки).
+        generation - поколение на момент чтения статуса из БД: если с тех пор кэш сбрасывался
+        (например, оплата), устаревший статус не записывается (False)
+        """
+        written = await self.redis.eval(
+            """
+            if ARGV[4] ~= '' and (redis.call('GET', KEYS[2]) or '0') ~= ARGV[4] then
+                return 0
+            end
+            redis.call('HSET', KEYS[1], 'sub_exp', ARGV[1], 'num_requests', ARGV[2])
+            redis.call('EXPIRE', KEYS[1], ARGV[3])
+            return 1
+            """,
+            2, f"entitlement:{user_id}", f"entitlement_gen:{user_id}",
+            "" if sub_exp is None else sub_exp, num_requests, ttl, 
+            "" if generation is None else generation
+        )
+        return bool(written)
+
+    @handle_redis_errors
+    async def incr_entitlement_requests(self, user_id, amount: int = 1):
+        """Увеличить счетчик запросов в кэше (только если запись уже есть)"""
+        await self.redis.eval(
+            """
+            if redis.call('EXISTS', KEYS[1]) == 1 then
+                return redis.call('HINCRBY', KEYS[1], 'num_requests', ARGV[1])
+            end
+            return nil
+            """,
+            1, f"entitlement:{user_id}", amount
+        )
+
+    @handle_redis_errors
+    async def delete_entitlement(self, user_id, ttl: int):
+        """Удалить статус пользователя из кэша и сменить поколение (ttl - время жизни записей кэша)"""
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(f"entitlement:{user_id}")
+            pipe.incr(f"entitlement_gen:{user_id}")
+            pipe.expire(f"entitlement_gen:{user_id}", ttl)
+            await pipe.execute()
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # Response cache (кэш ответов OpenAI на первый запрос диалога)
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    RESPONSE_CACHE_INDEX = "response_cache:index"
+
+    def _register_response_cache_scripts(self):
+        # KEYS[1] - response_cache:{hash}, KEYS[2] - индекс (ZSET hash -> время записи)
+        # ARGV[1] - hash, ARGV[2] - ответ, ARGV[3] - TTL, ARGV[4] - максимум записей, ARGV[5] - текущее время
+        # Сначала из индекса убираются истекшие записи, затем самые старые сверх лимита.
+        # Скрипт трогает только ключи из KEYS - вытесненные записи возвращаются и удаляются отдельно
+        self._set_cached_response_script = self.redis.register_script("""
+            local now = tonumber(ARGV[5])
+            local ttl = tonumber(ARGV[3])
+            redis.call('SET', KEYS[1], ARGV[2], 'EX', ttl)
+            redis.call('ZADD', KEYS[2], now, ARGV[1])
+            redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now - ttl)
+            local overflow = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[4])
+            if overflow <= 0 then
+                return {}
+            end
+            local oldest = redis.call('ZRANGE', KEYS[2], 0, overflow - 1)
+            redis.call('ZREMRANGEBYRANK', KEYS[2], 0, overflow - 1)
+            return oldest
+        """)
+
+    @handle_redis_errors
+    async def get_cached_response(self, key: str) -> dict | None:
+        """Закэшированный ответ {role, content, input_tokens, output_tokens}"""
+        value = await self.redis.get(f"response_cache:{key}")
+        return json.loads(value) if value else None
+
+    @handle_redis_errors
+    async def set_cached_response(self, key: str, response: dict, *, ttl: int, max_entries: int):
+        """Сохранить ответ (время жизни ttl секунд, не больше max_entries записей)"""
+        evicted = await self._set_cached_response_script(
+            keys=[f"response_cache:{key}", self.RESPONSE_CACHE_INDEX],
+            args=[key, json.dumps(response), ttl, max_entries, int(time.time())],
+        )
+        if evicted:
+            await self.redis.unlink(*[f"response_cache:{item}" for item in evicted])
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    # Pub/Sub
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    @handle_redis_errors
+    async def publish(self, channel: str, message):
+        """Отправить сообщение в канал (уведомление других реплик бота)"""
+        await self.redis.publish(channel, message)
+
+    def pubsub(self):
+        """Новый объект подписки на каналы"""
+        return self.redis.pubsub(ignore_subscribe_messages=True)
@@ -0,0 +1,125 @@
+import asyncio
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+from src.database.postrgeSQL import Database, UserState
+from src.config import USAGE_FLUSH_INTERVAL
+from src.logger import logger
+
+
+@dataclass
+class UsageDelta:
+    """Накопленные, но еще не записанные в БД счетчики пользователя"""
+    requests: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    last_req_date: datetime | None = None
+
+    def merge(self, other: "UsageDelta"):
+        self.requests += other.requests
+        self.input_tokens += other.input_tokens
+        self.output_tokens += other.output_tokens
+        if other.last_req_date and (self.last_req_date is None or other.last_req_date > self.last_req_date):
+            self.last_req_date = other.last_req_date
+
+
+class UsageAggregator:
+    """
+    Write-behind учет запросов и токенов.
+    Счетчики копятся в памяти и раз в USAGE_FLUSH_INTERVAL секунд
+    записываются в PostgreSQL одним пакетным UPDATE (плюс при остановке бота).
+    Так блокировка строки users и коммиты уходят из пути ответа пользователю.
+
+    USAGE_FLUSH_INTERVAL = 0 - запись сразу (Database.record_usage).
+    """
+    def __init__(self, db: Database):
+        self.db = db
+        self.pending: dict[int, UsageDelta] = {}
+        self.flushing: dict[int, UsageDelta] = {}
+        self.flush_lock = asyncio.Lock()
+        self.flush_task = None
+        self.closing = asyncio.Event()
+
+    @classmethod
+    async def create(cls, db: Database):
+        self = cls(db)
+        if USAGE_FLUSH_INTERVAL > 0:
+            self.flush_task = asyncio.create_task(self.flush_periodically())
+        return self
+
+    async def record(self, telegram_id: int, *, 
+                     requests: int = 0, 
+                     input_tokens: int = 0, 
+                     output_tokens: int = 0) -> UserState | None:
+        """
+        Учесть запрос/токены пользователя.
+        При записи сразу в БД возвращает состояние пользователя после обновления, иначе None.
+        """
+        if USAGE_FLUSH_INTERVAL > 0:
+            self.add(telegram_id, requests=requests, input_tokens=input_tokens, output_tokens=output_tokens)
+            return None
+        return await self.db.record_usage(
+            telegram_id, 
+            requests=requests, 
+            input_tokens=input_tokens, 
+            output_tokens=output_tokens
+        )
+
+    def add(self, telegram_id: int, *, requests: int = 0, input_tokens: int = 0, output_tokens: int = 0):
+        """Учесть запрос/токены пользователя (без обращения к БД)"""
+        delta = self.pending.setdefault(telegram_id, UsageDelta())
+        delta.requests += requests
+        delta.input_tokens += input_tokens
+        delta.output_tokens += output_tokens
+        if requests:
+            delta.last_req_date = datetime.now(timezone.utc)
+
+    def pending_requests(self, telegram_id: int) -> int:
+        """Количество запросов пользователя, еще не записанных в БД"""
+        requests = 0
+        for deltas in (self.pending, self.flushing):
+            if telegram_id in deltas:
+                requests += deltas[telegram_id].requests
+        return requests
+
+    async def flush(self):
+        """Записать накопленные счетчики в БД"""
+        async with self.flush_lock:
+            if not self.pending:
+                return
+            self.flushing, self.pending = self.pending, {}
+            rows = [
+                (telegram_id, d.requests, d.input_tokens, d.output_tokens, d.last_req_date)
+                for telegram_id, d in self.flushing.items()
+            ]
+            applied = False
+            try:
+                applied = await self.db.apply_usage_batch(rows)
+            finally:
+                if not applied:
+                    # Не получилось (или запись прервана) - возвращаем счетчики обратно,
+                    # попробуем в следующий раз
+                    for telegram_id, delta in self.flushing.items():
+                        self.pending.setdefault(telegram_id, UsageDelta()).merge(delta)
+                    logger.error(f"(Usage)\t Flush failed, {len(rows)} users kept pending")
+                self.flushing = {}
+
+    async def flush_periodically(self):
+        while not self.closing.is_set():
+            try:
+                await asyncio.wait_for(self.closing.wait(), USAGE_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"(Usage)\t Error while flushing: {e}")
+
+    async def close(self):
+        """Остановить фоновую запись и сбросить остатки в БД"""
+        # Не отменяем задачу посреди записи - просим ее завершиться после текущего flush
+        self.closing.set()
+        if self.flush_task:
+            await self.flush_task
+        await self.flush()
+        logger.info("(Usage)\t Usage aggregator flushed and closed")
@@ -1,11 +1,31 @@
 import openai
 from openai import AsyncOpenAI
 import asyncio
+import time
+from typing import Awaitable, Callable
 
-from src.config import OPENAI_API_KEY, ENVIRONMENT, MAX_TOKENS
+from src.config import (
+    OPENAI_API_KEY,
+    ENVIRONMENT,
+    MAX_TOKENS,
+    OPENAI_STREAM,
+    HISTORY_SUMMARY_MAX_TOKENS,
+    OPENAI_MAX_CONCURRENCY,
+    OPENAI_PRIORITY_WEIGHT,
+    OPENAI_RPM_LIMIT,
+    OPENAI_TPM_LIMIT,
+    OPENAI_MAX_RETRIES,
+    OPENAI_BACKOFF_BASE,
+    OPENAI_BACKOFF_MAX,
+)
+from src.gpt_scheduler import FairScheduler
+from src.gpt_ratelimit import RateLimiter, parse_retry_after, backoff_delay
+from src.tokens import count_message_tokens
 from src.logger import logger
+from src.prometheus_metrics import timed, OPENAI_IN_FLIGHT, OPENAI_LATENCY, completion_tokens_label
 
 def handle_openai_errors(func):
+    func = timed("openai")(func)
     async def wrapper(*args, **kwargs):
         try:
             return await func(*args, **kwargs)
@@ -21,7 +41,10 @@ class OpenAI_API():
             self.model_id = "gpt-4o-mini" if ENVIRONMENT=="prod" else "gpt-4o-mini"
             self.client = AsyncOpenAI(
                 api_key=OPENAI_API_KEY,  # This is the default and can be omitted
+                max_retries=0,  # Повторы с учетом лимитов делает self._create
             )
+            self.rate_limiter = RateLimiter(OPENAI_RPM_LIMIT, OPENAI_TPM_LIMIT)
+            self.scheduler = FairScheduler(OPENAI_MAX_CONCURRENCY, OPENAI_PRIORITY_WEIGHT)
             self.check_task = asyncio.create_task(self.check_connection())
         except Exception as e:
             logger.error(f"(OpenAI)\t Error initializing API: {e}")
@@ -57,16 +80,69 @@ class OpenAI_API():
             raise
 
     
+    async def _create(self, **kwargs):
+        """
+        chat.completions.create с клиентским ограничением RPM/TPM и повторами
+        (экспоненциальная задержка с джиттером, retry-after при 429).
+        Возвращает ответ (или поток) и оценку стоимости запроса в токенах.
+        """
+        estimated_tokens = sum(map(count_message_tokens, kwargs["messages"])) + kwargs["max_completion_tokens"]
+        for attempt in range(OPENAI_MAX_RETRIES + 1):
+            await self.rate_limiter.acquire(estimated_tokens)
+            try:
+                raw = await self.client.chat.completions.with_raw_response.create(**kwargs)
+            except openai.RateLimitError as e:
+                # Закончились деньги на счете - повторять бесполезно
+                if e.code == "insufficient_quota" or attempt == OPENAI_MAX_RETRIES:
+                    raise
+                self.rate_limiter.update_from_headers(e.response.headers)
+                retry_after = parse_retry_after(e.response.headers)
+                delay = backoff_delay(attempt, OPENAI_BACKOFF_BASE, OPENAI_BACKOFF_MAX)
+                # Останавливаем все запросы, а не только этот
+                self.rate_limiter.pause(delay if retry_after is None else retry_after + delay / 4)
+            except (openai.APIConnectionError, openai.InternalServerError) as e:
+                if attempt == OPENAI_MAX_RETRIES:
+                    raise
+                delay = backoff_delay(attempt, OPENAI_BACKOFF_BASE, OPENAI_BACKOFF_MAX)
+                logger.warning(f"(OpenAI)\t {e.__class__.__name__}, retry {attempt + 1} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+            else:
+                self.rate_limiter.update_from_headers(raw.headers)
+                return raw.parse(), estimated_tokens
+
     @handle_openai_errors
-    async def get_response(self, conversation_history: list, user_message: dict):
-        """Асинхронный запрос к OpenAI API"""
+    async def get_response(self, 
+                           conversation_history: list, 
+                           user_message: dict, 
+                           on_delta: Callable[[str], Awaitable[None]] | None = None,
+                           user_id: int | None = None,
+                           priority: bool = False):
+        """
+        Асинхронный запрос к OpenAI API
+        on_delta - если задан (и включен OPENAI_STREAM), ответ запрашивается потоком 
+        и каждый новый фрагмент текста передается в on_delta.
+        user_id, priority - для очереди FairScheduler (priority - активная подписка).
+        """
         api_message = conversation_history + [user_message]
         # logger.debug(f"(OpenAI)\t API message: {api_message}")
-        response = await self.client.chat.completions.create(
+        async with self.scheduler.slot(user_id, priority):
+            start = time.perf_counter()
+            with OPENAI_IN_FLIGHT.track_inprogress():
+                if on_delta is not None and OPENAI_STREAM:
+                    result = await self._get_response_stream(api_message, on_delta)
+                else:
+                    result = await self._get_response_once(api_message)
+        num_out_tokens = result[3] or 0
+        OPENAI_LATENCY.labels(completion_tokens_label(num_out_tokens)).observe(time.perf_counter() - start)
+        return result
+
+    async def _get_response_once(self, api_message: list):
+        response, estimated_tokens = await self._create(
             model=self.model_id,
             messages=api_message,
             max_completion_tokens=MAX_TOKENS,
         )
+        self.rate_limiter.settle(estimated_tokens, response.usage.total_tokens)
         logger.debug(f"(OpenAI)\t Get response from OpenAI")
 
         # length    - что-то недописал по причине ограничения max_completion_tokens
@@ -82,6 +158,68 @@ class OpenAI_API():
         
         return assistent_reply, role, num_in_tokens, num_out_tokens
 
+    async def _get_response_stream(self, api_message: list, on_delta: Callable[[str], Awaitable[None]]):
+        """Потоковый запрос (stream=True). Usage приходит последним чанком (include_usage)"""
+        stream, estimated_tokens = await self._create(
+            model=self.model_id,
+            messages=api_message,
+            max_completion_tokens=MAX_TOKENS,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        parts = []
+        role = "assistant"
+        finish_reason = None
+        num_in_tokens = num_out_tokens = 0
+
+        async for chunk in stream:
+            if chunk.usage:
+                num_in_tokens = chunk.usage.prompt_tokens
+                num_out_tokens = chunk.usage.completion_tokens
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if choice.delta.role:
+                role = choice.delta.role
+            if choice.delta.content:
+                parts.append(choice.delta.content)
+                await on_delta(choice.delta.content)
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+
+        if num_in_tokens or num_out_tokens:
+            self.rate_limiter.settle(estimated_tokens, num_in_tokens + num_out_tokens)
+
+        logger.debug(f"(OpenAI)\t Get streamed response from OpenAI")
+        logger.debug(f"(OpenAI)\t Finish_reason: {finish_reason}")
+
+        assistent_reply = "".join(parts).strip()
+        return assistent_reply, role, num_in_tokens, num_out_tokens
+
+    @handle_openai_errors
+    async def summarize_history(self, messages: list, user_id: int | None = None):
+        """Краткое содержание части диалога (для сжатия истории). В очереди без приоритета"""
+        dialog = "\n\n".join(f"{message['role']}: {message['content']}" for message in messages)
+        async with self.scheduler.slot(user_id, priority=False), OPENAI_IN_FLIGHT.track_inprogress():
+            response, estimated_tokens = await self._create(
+                model=self.model_id,
+                messages=[
+                    {
+                        'role': 'system',
+                        'content': (
+                            "Кратко перескажи диалог пользователя с ассистентом. "
+                            "Сохрани факты, договоренности, имена, код и данные, которые могут понадобиться дальше. "
+                            "Пиши на языке диалога, без вступлений."
+                        )
+                    },
+                    {'role': 'user', 'content': dialog},
+                ],
+                max_completion_tokens=HISTORY_SUMMARY_MAX_TOKENS,
+            )
+        self.rate_limiter.settle(estimated_tokens, response.usage.total_tokens)
+        summary = response.choices[0].message.content.strip()
+        return summary, response.usage.prompt_tokens, response.usage.completion_tokens
+
     @handle_openai_errors
     async def chatgpt_conversation(self, user_text: str, conversation: list = []):
         if conversation:
@@ -0,0 +1,104 @@
+import asyncio
+import random
+import re
+import time
+
+from src.logger import logger
+from src.ratelimit import TokenBucket
+
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_reset_duration(value: str | None) -> float | None:
+    """'1s', '6m0s', '20ms', '1h2m3.5s' (x-ratelimit-reset-*) -> секунды"""
+    if not value:
+        return None
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+def parse_retry_after(headers) -> float | None:
+    """retry-after-ms / retry-after (секунды) -> секунды"""
+    if headers is None:
+        return None
+    for header, scale in (("retry-after-ms", 0.001), ("retry-after", 1)):
+        value = headers.get(header)
+        if value is None:
+            continue
+        try:
+            return max(0.0, float(value) * scale)
+        except ValueError:
+            continue
+    return None
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Экспоненциальная задержка с полным джиттером (attempt с 0)"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class RateLimiter:
+    """
+    Клиентское ограничение запросов к OpenAI: RPM и TPM.
+    Стоимость запроса в токенах оценивается заранее (вход + max_completion_tokens),
+    как это делает сам OpenAI.
+    Заголовки x-ratelimit-* уточняют остаток, retry-after приостанавливает все запросы.
+    """
+    def __init__(self, rpm: int, tpm: int):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.paused_until = 0.0
+
+    async def acquire(self, estimated_tokens: int):
+        while True:
+            while (delay := self.paused_until - time.monotonic()) > 0:
+                await asyncio.sleep(delay)
+            await self.requests.acquire(1)
+            await self.tokens.acquire(estimated_tokens)
+            if self.paused_until <= time.monotonic():
+                return
+            # Пауза (429) началась, пока ждали ведра - возвращаем списанное и ждем снова
+            self.requests.adjust(1)
+            self.tokens.adjust(estimated_tokens)
+
+    def settle(self, estimated_tokens: int, actual_tokens: int | None):
+        """
+        Доплатить, если запрос оказался дороже оценки. Неиспользованное не возвращаем:
+        OpenAI тоже списывает TPM по max_completion_tokens, а не по фактическому ответу
+        """
+        if actual_tokens is not None and actual_tokens > estimated_tokens:
+            self.tokens.adjust(estimated_tokens - actual_tokens)
+
+    def pause(self, seconds: float):
+        """Приостановить все запросы (429 / retry-after)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        logger.warning(f"(OpenAI)\t Rate limited, requests paused for {seconds:.1f}s")
+
+    def update_from_headers(self, headers):
+        if headers is None:
+            return
+        for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+            remaining = _int_header(headers, f"x-ratelimit-remaining-{kind}")
+            bucket.sync(
+                limit=_int_header(headers, f"x-ratelimit-limit-{kind}"),
+                remaining=remaining,
+            )
+            # Лимит исчерпан - ждем сброса, не дожидаясь 429
+            reset = parse_reset_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+            if remaining == 0 and reset:
+                self.pause(reset)
+
+
+def _int_header(headers, name: str) -> int | None:
+    value = headers.get(name)
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
@@ -0,0 +1,115 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from src.prometheus_metrics import OPENAI_QUEUE_DEPTH, OPENAI_QUEUE_WAIT
+
+
+class _Lane:
+    """Очередь одного уровня приоритета: round-robin по пользователям"""
+    def __init__(self, tier: str):
+        self.tier = tier
+        self.users: OrderedDict[int | None, deque[asyncio.Future]] = OrderedDict()
+        self.size = 0
+
+    def push(self, user_id: int | None, waiter: asyncio.Future):
+        self.users.setdefault(user_id, deque()).append(waiter)
+        self.size += 1
+        OPENAI_QUEUE_DEPTH.labels(self.tier).set(self.size)
+
+    def pop(self) -> asyncio.Future | None:
+        """Следующий ожидающий: первый запрос пользователя из начала очереди, пользователь уходит в конец"""
+        while self.users:
+            user_id, waiters = self.users.popitem(last=False)
+            waiter = waiters.popleft()
+            if waiters:
+                self.users[user_id] = waiters
+            self.size -= 1
+            OPENAI_QUEUE_DEPTH.labels(self.tier).set(self.size)
+            if not waiter.done():
+                return waiter
+        return None
+
+    def remove(self, user_id: int | None, waiter: asyncio.Future):
+        waiters = self.users.get(user_id)
+        if waiters is None or waiter not in waiters:
+            return
+        waiters.remove(waiter)
+        if not waiters:
+            del self.users[user_id]
+        self.size -= 1
+        OPENAI_QUEUE_DEPTH.labels(self.tier).set(self.size)
+
+
+class FairScheduler:
+    """
+    Ограничение количества одновременных запросов к OpenAI.
+    Сверх лимита запросы ждут в очереди: пользователи обслуживаются по кругу (round-robin),
+    поэтому один пользователь с несколькими запросами не задерживает остальных.
+    Подписчики в приоритете: на каждые priority_weight запросов подписчиков
+    обслуживается один запрос пробного периода (если такие ждут).
+    """
+    def __init__(self, max_concurrency: int, priority_weight: int = 4):
+        self.max_concurrency = max(1, max_concurrency)
+        self.priority_weight = max(1, priority_weight)
+        self.active = 0
+        self.priority_streak = 0
+        self.lanes = {
+            True: _Lane("paid"),
+            False: _Lane("trial"),
+        }
+
+    @property
+    def queued(self) -> int:
+        return sum(lane.size for lane in self.lanes.values())
+
+    @asynccontextmanager
+    async def slot(self, user_id: int | None = None, priority: bool = False):
+        """Занять место на время запроса к OpenAI"""
+        await self.acquire(user_id, priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, user_id: int | None = None, priority: bool = False):
+        lane = self.lanes[priority]
+        if self.active < self.max_concurrency and not self.queued:
+            self.active += 1
+            OPENAI_QUEUE_WAIT.labels(lane.tier).observe(0)
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        lane.push(user_id, waiter)
+        start = time.monotonic()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Место уже выдано - возвращаем его следующему
+                self.release()
+            else:
+                lane.remove(user_id, waiter)
+            raise
+        OPENAI_QUEUE_WAIT.labels(lane.tier).observe(time.monotonic() - start)
+
+    def release(self):
+        self.active -= 1
+        while self.active < self.max_concurrency:
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
+            self.active += 1
+            waiter.set_result(None)
+
+    def _next_waiter(self) -> asyncio.Future | None:
+        paid, trial = self.lanes[True], self.lanes[False]
+        if trial.size and (not paid.size or self.priority_streak >= self.priority_weight):
+            self.priority_streak = 0
+            return trial.pop() or paid.pop()
+        waiter = paid.pop()
+        if waiter is not None:
+            self.priority_streak += 1
+            return waiter
+        return trial.pop()
@@ -0,0 +1,73 @@
+import asyncio
+
+from src.database import Redis, UsageAggregator
+from src.gpt import OpenAI_API
+from src.tokens import count_message_tokens
+from src.config import (
+    HISTORY_COMPACTION_ENABLED,
+    HISTORY_COMPACTION_THRESHOLD,
+    HISTORY_COMPACTION_KEEP,
+)
+from src.prometheus_metrics import TOKENS_COUNTER
+from src.logger import logger
+
+
+class HistoryCompactor:
+    """
+    Сжатие истории диалога: когда сообщений больше HISTORY_COMPACTION_THRESHOLD,
+    все, кроме последних HISTORY_COMPACTION_KEEP, заменяются одним сообщением с кратким содержанием.
+    Выполняется в фоне после ответа пользователю. Если история изменилась за время
+    сжатия (версия в Redis), результат отбрасывается.
+    """
+    SUMMARY_PREFIX = "Краткое содержание предыдущей части диалога:\n"
+
+    def __init__(self, redis: Redis, openai: OpenAI_API, usage: UsageAggregator):
+        self.redis = redis
+        self.openai = openai
+        self.usage = usage
+        self.tasks: dict[int, asyncio.Task] = {}
+
+    def schedule(self, user_id: int, history_len: int):
+        """Запустить сжатие в фоне, если история превысила порог"""
+        if not HISTORY_COMPACTION_ENABLED or history_len <= HISTORY_COMPACTION_THRESHOLD:
+            return
+        if user_id in self.tasks:
+            return  # Уже сжимается
+        task = asyncio.create_task(self.compact(user_id))
+        self.tasks[user_id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(user_id, None))
+
+    async def compact(self, user_id: int):
+        try:
+            head = await self.redis.get_history_head(user_id, keep=HISTORY_COMPACTION_KEEP)
+            if not head:
+                return
+            version, messages = head
+            if len(messages) < 2:
+                return  # Сжимать нечего (например, только предыдущее summary)
+
+            result = await self.openai.summarize_history(messages, user_id=user_id)
+            summary_text, num_in_tokens, num_out_tokens = result
+            await self.usage.record(user_id, input_tokens=num_in_tokens, output_tokens=num_out_tokens)
+            TOKENS_COUNTER.labels("input", "compaction").inc(num_in_tokens)
+            TOKENS_COUNTER.labels("output", "compaction").inc(num_out_tokens)
+
+            summary = {'role': 'system', 'content': self.SUMMARY_PREFIX + summary_text}
+            replaced = await self.redis.replace_history_head(
+                user_id,
+                version=version,
+                count=len(messages),
+                summary=summary,
+                summary_tokens=count_message_tokens(summary),
+            )
+            if replaced:
+                logger.debug(f"(Compaction)\t User {user_id}: {len(messages)} messages compacted")
+            else:
+                logger.debug(f"(Compaction)\t User {user_id}: history changed, compaction skipped")
+        except Exception as e:
+            logger.error(f"(Compaction)\t Error compacting history of user {user_id}: {e}")
+
+    async def close(self):
+        """Дождаться фоновых сжатий"""
+        if self.tasks:
+            await asyncio.gather(*self.tasks.values(), return_exceptions=True)
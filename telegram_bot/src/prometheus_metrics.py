@@ -1,4 +1,10 @@
-from prometheus_client import Summary, Histogram, Counter
+import asyncio
+import time
+from functools import wraps
+
+from prometheus_client import Summary, Histogram, Counter, Gauge
+
+from src.tracing import trace_span
 
 
 # Метрика для времени ответа (обработки запроса)
@@ -9,3 +15,67 @@ MESSAGE_RESPONSE_TIME = Histogram(
     )
 MESSAGE_RPS_COUNTER = Counter('aiogram_rps', 'Messages count')
 ERRORS_COUNTER = Counter('aiogram_errors', 'Number of errors in Aiogram', ['error_type'])
+PENDING_DELETIONS = Gauge('aiogram_pending_deletions', 'Technical messages waiting for deletion')
+PENDING_DELIVERIES = Gauge('aiogram_pending_deliveries', 'Outgoing messages waiting in the delivery queue')
+REDIS_UNLINKED_KEYS = Counter('redis_maintenance_unlinked_keys', 'Keys deleted by Redis maintenance (SCAN + UNLINK)', ['pattern'])
+OPENAI_QUEUE_DEPTH = Gauge('openai_queue_depth', 'Requests waiting for an OpenAI slot', ['tier'])
+OPENAI_QUEUE_WAIT = Histogram(
+    'openai_queue_wait_seconds',
+    'Time spent waiting for an OpenAI slot',
+    ['tier'],
+    buckets=[0, 0.1, 0.5, 1, 2, 5, 10, 30, 60]
+    )
+RESPONSE_CACHE_REQUESTS = Counter('openai_response_cache_requests', 'First-turn response cache lookups', ['result'])
+
+# Время этапов обработки (postgres, redis, openai, render, telegram)
+STAGE_LATENCY = Histogram(
+    'aiogram_stage_duration_seconds',
+    'Time spent in a processing stage',
+    ['stage', 'operation', 'outcome'],
+    buckets=[0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60]
+    )
+# tier: trial / paid / compaction, cached - ответы из кэша (OpenAI их не списывал)
+TOKENS_COUNTER = Counter('openai_tokens', 'OpenAI tokens used', ['direction', 'tier'])
+OPENAI_IN_FLIGHT = Gauge('openai_requests_in_flight', 'OpenAI requests in progress (including client-side rate limit wait)')
+OPENAI_LATENCY = Histogram(
+    'openai_request_duration_seconds',
+    'OpenAI request duration by completion size',
+    ['completion_tokens'],
+    buckets=[0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120]
+    )
+COMPLETION_TOKEN_BUCKETS = (128, 512, 2048)
+
+
+def completion_tokens_label(num_tokens: int) -> str:
+    """Размер ответа для метки OPENAI_LATENCY: <128, <512, <2048, >=2048"""
+    for limit in COMPLETION_TOKEN_BUCKETS:
+        if num_tokens < limit:
+            return f"<{limit}"
+    return f">={COMPLETION_TOKEN_BUCKETS[-1]}"
+
+
+def timed(stage: str, operation: str | None = None):
+    """
+    Замер времени асинхронной функции в STAGE_LATENCY (outcome = ok / error / cancelled)
+    и интервал "{stage}.{operation}" в трассе апдейта.
+    Ставится под handle_*_errors, чтобы видеть исключения до их обработки.
+    """
+    def decorator(func):
+        name = operation or func.__name__
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                with trace_span(f"{stage}.{name}"):
+                    result = await func(*args, **kwargs)
+                outcome = "ok"
+                return result
+            except asyncio.CancelledError:
+                outcome = "cancelled"
+                raise
+            finally:
+                STAGE_LATENCY.labels(stage, name, outcome).observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
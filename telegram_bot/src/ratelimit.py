@@ -0,0 +1,53 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Ведро токенов с непрерывным пополнением: capacity единиц за period секунд
+    (capacity - и максимальный всплеск). Ожидающие обслуживаются по очереди (FIFO).
+    """
+    def __init__(self, capacity: float, period: float = 60):
+        self.capacity = float(capacity)
+        self.period = period
+        self.available = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / self.period
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def is_full(self) -> bool:
+        self._refill()
+        return self.available >= self.capacity
+
+    async def acquire(self, amount: float = 1):
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.available >= amount:
+                    self.available -= amount
+                    return
+                await asyncio.sleep((amount - self.available) / self.rate)
+
+    def adjust(self, amount: float):
+        """Добавить (amount > 0) или списать (amount < 0) единицы вне очереди"""
+        self._refill()
+        self.available = min(self.capacity, self.available + amount)
+
+    def sync(self, limit: int | None, remaining: int | None):
+        """Подстроиться под x-ratelimit-* заголовки ответа"""
+        self._refill()
+        if limit:
+            self.capacity = float(limit)
+        if remaining is not None:
+            # Сервер учитывает и запросы других копий бота - не даем себе больше, чем осталось
+            self.available = min(self.available, float(remaining))
@@ -0,0 +1,59 @@
+import hashlib
+import json
+
+from src.database import Redis
+from src.config import (
+    MAX_TOKENS,
+    RESPONSE_CACHE_ENABLED,
+    RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_MAX_ENTRIES,
+)
+from src.prometheus_metrics import RESPONSE_CACHE_REQUESTS
+from src.logger import logger
+
+
+def normalize_message(message: dict) -> dict:
+    """Пробелы не влияют на ключ кэша (регистр может менять смысл запроса - его сохраняем)"""
+    return {'role': message['role'], 'content': " ".join(message['content'].split())}
+
+
+def response_cache_key(model_id: str, max_tokens: int, messages: list) -> str:
+    payload = json.dumps(
+        [model_id, max_tokens, [normalize_message(message) for message in messages]],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Кэш ответов OpenAI на первый запрос диалога (пустая история) - точное совпадение
+    модели, MAX_TOKENS и нормализованного текста. Включается RESPONSE_CACHE_ENABLED.
+    Записи живут RESPONSE_CACHE_TTL секунд, хранится не больше RESPONSE_CACHE_MAX_ENTRIES.
+    Ошибки Redis не мешают ответу - запрос просто уходит в OpenAI.
+    """
+    def __init__(self, redis: Redis, enabled: bool = RESPONSE_CACHE_ENABLED):
+        self.redis = redis
+        self.enabled = enabled
+
+    def key(self, model_id: str, messages: list) -> str:
+        return response_cache_key(model_id, MAX_TOKENS, messages)
+
+    async def get(self, key: str) -> dict | None:
+        try:
+            cached = await self.redis.get_cached_response(key)
+        except Exception:
+            cached = None
+        RESPONSE_CACHE_REQUESTS.labels("hit" if cached else "miss").inc()
+        return cached
+
+    async def set(self, key: str, response: dict):
+        try:
+            await self.redis.set_cached_response(
+                key, response,
+                ttl=RESPONSE_CACHE_TTL,
+                max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+            )
+        except Exception as e:
+            logger.warning(f"(Cache)\t\t Response not cached: {e}")
@@ -0,0 +1,44 @@
+import asyncio
+
+from src.logger import logger
+
+# Служебные токены на каждое сообщение в chat.completions (role, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_encoding = None
+_encoding_loaded = False
+
+
+def _get_encoding():
+    """Ленивая загрузка токенизатора (tiktoken скачивает словарь при первом использовании)"""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("o200k_base")  # gpt-4o / gpt-4o-mini
+        except Exception as e:
+            logger.warning(f"(Tokens)\t tiktoken is unavailable, using approximate token count: {e}")
+    return _encoding
+
+
+async def preload_encoding():
+    """
+    Загрузить токенизатор при старте бота в отдельном потоке:
+    скачивание словаря и сборка кодировщика занимают секунды и не должны блокировать цикл событий
+    """
+    await asyncio.to_thread(_get_encoding)
+
+
+def count_tokens(text: str) -> int:
+    """Количество токенов в тексте (приблизительно, если tiktoken недоступен)"""
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    # ~4 байта UTF-8 на токен (латиница ~4 символа, кириллица ~2 символа)
+    return len(text.encode("utf-8")) // 4 + 1
+
+
+def count_message_tokens(message: dict) -> int:
+    """Количество токенов сообщения истории {'role': ..., 'content': ...}"""
+    return count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
@@ -0,0 +1,155 @@
+"""
+Легкая трассировка обработки апдейтов.
+
+Для каждого апдейта создается Trace (contextvars), в него записываются интервалы (spans)
+по монотонным часам: middleware, запросы к Postgres / Redis / OpenAI, отправка сообщений.
+Трасса завершается, когда закончены обработка апдейта и все связанные с ним отправки.
+Завершенные трассы выборочно (TRACE_SAMPLE_RATE, а также все медленнее TRACE_SLOW_THRESHOLD)
+пишутся в JSON lines файл TRACE_FILE через QueueHandler, не блокируя цикл событий.
+"""
+import asyncio
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+from src.config import TRACE_ENABLED, TRACE_SAMPLE_RATE, TRACE_SLOW_THRESHOLD, TRACE_FILE
+
+
+MAX_SPANS = 200
+
+current_trace: ContextVar["Trace | None"] = ContextVar("current_trace", default=None)
+_current_depth: ContextVar[int] = ContextVar("current_span_depth", default=0)
+
+
+@dataclass
+class Span:
+    name: str
+    start: float
+    depth: int
+    duration: float = 0.0
+    outcome: str = "ok"
+
+    def as_dict(self, trace_start: float) -> dict:
+        return {
+            "name": self.name,
+            "start_ms": round((self.start - trace_start) * 1000, 3),
+            "duration_ms": round(self.duration * 1000, 3),
+            "depth": self.depth,
+            "outcome": self.outcome,
+        }
+
+
+@dataclass
+class Trace:
+    update_id: int | None
+    user_id: int | None = None
+    start: float = field(default_factory=time.monotonic)
+    wall_start: float = field(default_factory=time.time)
+    spans: list[Span] = field(default_factory=list)
+    holds: int = 0
+    dropped_spans: int = 0
+    finished: bool = False
+
+    def hold(self):
+        """Трасса не завершится, пока не вызван release (например, до отправки ответа)"""
+        self.holds += 1
+
+    def release(self):
+        self.holds -= 1
+        if self.holds == 0:
+            self.finish()
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        duration = time.monotonic() - self.start
+        if duration >= TRACE_SLOW_THRESHOLD or random.random() < TRACE_SAMPLE_RATE:
+            write_trace(self, duration)
+
+    def as_dict(self, duration: float) -> dict:
+        return {
+            "update_id": self.update_id,
+            "user_id": self.user_id,
+            "start": round(self.wall_start, 3),
+            "duration_ms": round(duration * 1000, 3),
+            "spans": [span.as_dict(self.start) for span in self.spans],
+            "dropped_spans": self.dropped_spans,
+        }
+
+
+@contextmanager
+def trace_span(name: str):
+    """Записать интервал в текущую трассу (если она есть)"""
+    trace = current_trace.get()
+    if trace is None or trace.finished:
+        yield
+        return
+    if len(trace.spans) >= MAX_SPANS:
+        trace.dropped_spans += 1
+        yield
+        return
+
+    depth = _current_depth.get()
+    span = Span(name=name, start=time.monotonic(), depth=depth)
+    trace.spans.append(span)
+    token = _current_depth.set(depth + 1)
+    try:
+        yield span
+    except asyncio.CancelledError:
+        span.outcome = "cancelled"
+        raise
+    except BaseException:
+        span.outcome = "error"
+        raise
+    finally:
+        span.duration = time.monotonic() - span.start
+        _current_depth.reset(token)
+
+
+def new_trace(update_id: int | None, user_id: int | None = None) -> Trace | None:
+    """Новая трасса апдейта (None, если трассировка выключена). Завершается вызовом release"""
+    if not TRACE_ENABLED:
+        return None
+    trace = Trace(update_id=update_id, user_id=user_id)
+    trace.hold()
+    return trace
+
+
+# Запись в файл из отдельного потока (QueueListener)
+_trace_logger = logging.getLogger("chatgpt_telegram_bot.traces")
+_trace_logger.propagate = False
+_trace_listener = None
+
+
+def _ensure_sink():
+    global _trace_listener
+    if _trace_listener is not None:
+        return
+    trace_queue = queue.SimpleQueue()
+    file_handler = logging.FileHandler(TRACE_FILE, encoding="utf-8")
+    file_handler.setFormatter(logging.Formatter("%(message)s"))
+    _trace_listener = logging.handlers.QueueListener(trace_queue, file_handler)
+    _trace_listener.start()
+    _trace_logger.addHandler(logging.handlers.QueueHandler(trace_queue))
+    _trace_logger.setLevel(logging.INFO)
+
+
+def write_trace(trace: Trace, duration: float):
+    _ensure_sink()
+    _trace_logger.info(json.dumps(trace.as_dict(duration), ensure_ascii=False))
+
+
+def close_traces():
+    """Дописать оставшиеся трассы в файл"""
+    global _trace_listener
+    if _trace_listener is not None:
+        _trace_listener.stop()
+        _trace_listener = None
+        _trace_logger.handlers.clear()
@@ -1,2 +1,13 @@
 from src.gpt import OpenAI_API
-from src.database import Database
\ No newline at end of file
+from src.database import Database
+from src.database.history_codec import encode_history_entry, decode_history_entry
+from src.gpt_scheduler import FairScheduler
+from src.ratelimit import TokenBucket
+from src.gpt_ratelimit import RateLimiter, parse_reset_duration, parse_retry_after
+from src.response_cache import response_cache_key
+from src.aiogram.utils.message_split import MessageChunker, split_message
+from src.database import usage as usage_module
+from src.database.usage import UsageAggregator
+from src.database.redisCRUD import WaiterRegistry
+from src.aiogram.utils import deletion_scheduler as deletion_module
+from src.aiogram.utils.deletion_scheduler import DeletionScheduler
@@ -0,0 +1,70 @@
+import asyncio
+
+from . import WaiterRegistry, deletion_module, DeletionScheduler
+
+
+class FakeBot:
+    def __init__(self):
+        self.deleted = []
+
+    async def delete_message(self, chat_id, message_id):
+        self.deleted.append((chat_id, message_id))
+
+    async def delete_messages(self, chat_id, message_ids):
+        self.deleted.extend((chat_id, message_id) for message_id in message_ids)
+
+
+class FakeRedis:
+    def __init__(self):
+        self.waiters = WaiterRegistry()
+
+    async def is_user_waiting(self, user_id):
+        return 1  # Запрос пользователя еще обрабатывается
+
+
+def test_oldest_is_deleted_when_queue_is_full(monkeypatch):
+    monkeypatch.setattr(deletion_module, "DELETION_MAX_PENDING", 2)
+
+    async def scenario():
+        scheduler = DeletionScheduler(FakeBot(), FakeRedis())
+        for message_id in (1, 2, 3):
+            await scheduler.schedule(10, message_id, user_id=1, trigger="inactive", delay=60)
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert scheduler.due == {10: [1]}
+    assert scheduler.pending == 2
+
+
+def test_reschedule_replaces_trigger():
+    async def scenario():
+        scheduler = DeletionScheduler(FakeBot(), FakeRedis())
+        await scheduler.schedule(10, 1, user_id=1, trigger="inactive", delay=60)
+        await scheduler.schedule(10, 1, user_id=1, trigger="active", delay=60)
+        # Прежнее условие больше не действует
+        scheduler.on_user_state(1, "inactive")
+        assert scheduler.due == {}
+        scheduler.on_user_state(1, "active")
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert scheduler.due == {10: [1]}
+    assert scheduler.pending == 0
+
+
+def test_close_deletes_pending_messages():
+    bot = FakeBot()
+    redis = FakeRedis()
+
+    async def scenario():
+        scheduler = await DeletionScheduler.create(bot, redis)
+        await scheduler.schedule(10, 1, user_id=1, trigger="inactive", delay=60)
+        await scheduler.schedule(10, 2, user_id=1, trigger="active", delay=60)
+        await scheduler.schedule(20, 3, user_id=2, trigger="inactive", delay=60)
+        await scheduler.close()
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert sorted(bot.deleted) == [(10, 1), (10, 2), (20, 3)]
+    assert scheduler.pending == 0
+    assert redis.waiters.listeners == []
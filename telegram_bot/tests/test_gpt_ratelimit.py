@@ -0,0 +1,50 @@
+import asyncio
+import time
+
+from . import RateLimiter, TokenBucket, parse_reset_duration, parse_retry_after
+
+
+def test_parse_reset_duration():
+    assert parse_reset_duration("1s") == 1
+    assert parse_reset_duration("6m0s") == 360
+    assert parse_reset_duration("20ms") == 0.02
+    assert parse_reset_duration(None) is None
+
+
+def test_parse_retry_after():
+    assert parse_retry_after({"retry-after-ms": "250", "retry-after": "1"}) == 0.25
+    assert parse_retry_after({"retry-after": "2"}) == 2
+    assert parse_retry_after({}) is None
+
+
+def test_token_bucket_waits_for_refill():
+    async def main():
+        bucket = TokenBucket(capacity=600)  # 10 в секунду
+        await bucket.acquire(600)
+        start = time.monotonic()
+        await bucket.acquire(2)
+        return time.monotonic() - start
+
+    assert 0.15 <= asyncio.run(main()) < 0.5
+
+
+def test_token_bucket_sync_with_headers():
+    bucket = TokenBucket(capacity=100)
+    bucket.sync(limit=1000, remaining=10)
+    assert bucket.capacity == 1000
+    assert bucket.available <= 10 + 1
+
+
+def test_rate_limiter_rechecks_pause_after_bucket_wait():
+    async def main():
+        limiter = RateLimiter(rpm=600, tpm=10**6)  # 10 запросов в секунду
+        await limiter.requests.acquire(600)
+        start = time.monotonic()
+        waiter = asyncio.create_task(limiter.acquire(100))
+        await asyncio.sleep(0.01)
+        # 429 пришел, пока запрос ждал ведра запросов
+        limiter.pause(0.4)
+        await waiter
+        return time.monotonic() - start
+
+    assert asyncio.run(main()) >= 0.4
@@ -0,0 +1,51 @@
+import asyncio
+
+from . import FairScheduler
+
+
+async def _run(scheduler: FairScheduler, requests: list[tuple[int, bool]]) -> list[int]:
+    order = []
+    gate = asyncio.Event()
+
+    async def request(user_id: int, priority: bool):
+        async with scheduler.slot(user_id, priority):
+            order.append(user_id)
+            await gate.wait()
+
+    # Первый запрос занимает единственное место, остальные встают в очередь
+    tasks = [asyncio.create_task(request(0, False))]
+    await asyncio.sleep(0)
+    for user_id, priority in requests:
+        tasks.append(asyncio.create_task(request(user_id, priority)))
+    await asyncio.sleep(0)
+    gate.set()
+    await asyncio.gather(*tasks)
+    return order[1:]
+
+
+def test_round_robin_between_users():
+    scheduler = FairScheduler(max_concurrency=1)
+    order = asyncio.run(_run(scheduler, [(1, False), (1, False), (1, False), (2, False), (3, False)]))
+    assert order == [1, 2, 3, 1, 1]
+
+
+def test_subscribers_first_but_trial_not_starved():
+    scheduler = FairScheduler(max_concurrency=1, priority_weight=2)
+    requests = [(1, False), (2, False)] + [(10 + i, True) for i in range(4)]
+    order = asyncio.run(_run(scheduler, requests))
+    assert order == [10, 11, 1, 12, 13, 2]
+
+
+def test_cancelled_waiter_frees_queue():
+    async def main():
+        scheduler = FairScheduler(max_concurrency=1)
+        await scheduler.acquire(1)
+        waiter = asyncio.create_task(scheduler.acquire(2))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert scheduler.queued == 0
+        scheduler.release()
+        assert scheduler.active == 0
+
+    asyncio.run(main())
@@ -0,0 +1,23 @@
+import json
+
+from . import encode_history_entry, decode_history_entry
+
+
+def test_short_message_roundtrip():
+    message = {'role': 'user', 'content': 'Привет! Hello!'}
+    entry = encode_history_entry(message)
+    assert len(entry) < len(json.dumps(message).encode())
+    assert decode_history_entry(entry) == message
+
+
+def test_long_message_is_compressed():
+    message = {'role': 'assistant', 'content': 'Ответ бота. ' * 1000}
+    entry = encode_history_entry(message)
+    assert len(entry) < len(message['content'].encode()) // 10
+    assert decode_history_entry(entry) == message
+
+
+def test_legacy_json_entry():
+    message = {'role': 'assistant', 'content': 'old'}
+    assert decode_history_entry(json.dumps(message)) == message
+    assert decode_history_entry(json.dumps(message).encode()) == message
@@ -0,0 +1,52 @@
+from . import MessageChunker, split_message
+
+
+def test_parts_fit_limits():
+    text = "\n".join(f"Строка {i} " + "слово " * (i % 30) for i in range(2000))
+    parts = split_message(text, with_photo=True)
+    assert len(parts[0]) <= 1024
+    assert all(len(part) <= 4096 for part in parts[1:])
+    assert " ".join(" ".join(parts).split()) == " ".join(text.split())
+
+
+def test_long_word_is_cut():
+    parts = split_message("x" * 10000, with_photo=False)
+    assert [len(part) for part in parts] == [4096, 4096, 1808]
+
+
+def test_code_fence_is_reopened():
+    code = "\n".join(f"print({i})" for i in range(1000))
+    text = "Пример:\n```python\n" + code + "\n```\nГотово"
+    parts = split_message(text, with_photo=False)
+    assert len(parts) > 1
+    for part in parts:
+        assert len(part) <= 4096
+        assert part.count("```") % 2 == 0
+    assert parts[1].startswith("```python\n")
+    assert parts[-1].endswith("```\nГотово")
+
+
+def test_inline_markup_is_reopened():
+    text = "**" + "жирный " * 1000 + "**"
+    parts = split_message(text, with_photo=False)
+    assert len(parts) > 1
+    assert all(part.startswith("**") and part.endswith("**") for part in parts)
+
+
+def test_incremental_feed_matches_split():
+    text = "Ответ:\n```\n" + "строка кода\n" * 2000 + "```\n" + "текст " * 3000
+    chunker = MessageChunker()
+    parts = []
+    for i in range(0, len(text), 7):
+        parts.extend(chunker.feed(text[i:i + 7]))
+    parts.extend(chunker.flush())
+    assert parts == split_message(text, with_photo=False)
+
+
+def test_limit_is_checked_on_sent_length():
+    # Отправляемый текст вдвое длиннее исходного (как при экранировании)
+    text = "Ответ:\n```\n" + "строка кода\n" * 1000 + "```\n" + "текст " * 2000
+    chunker = MessageChunker(length=lambda part: 2 * len(part))
+    parts = [*chunker.feed(text), *chunker.flush()]
+    assert all(2 * len(part) <= 4096 for part in parts)
+    assert all(part.count("```") % 2 == 0 for part in parts)
@@ -0,0 +1,20 @@
+from . import response_cache_key
+
+
+def test_key_ignores_whitespace():
+    a = response_cache_key("gpt-4o-mini", 1000, [{'role': 'user', 'content': "Привет!  Что ты умеешь?"}])
+    b = response_cache_key("gpt-4o-mini", 1000, [{'role': 'user', 'content': " Привет! Что ты\nумеешь? "}])
+    assert a == b
+
+
+def test_key_depends_on_case():
+    a = response_cache_key("gpt-4o-mini", 1000, [{'role': 'user', 'content': "Что такое NaN?"}])
+    b = response_cache_key("gpt-4o-mini", 1000, [{'role': 'user', 'content': "что такое nan?"}])
+    assert a != b
+
+
+def test_key_depends_on_model_and_max_tokens():
+    messages = [{'role': 'user', 'content': "Привет"}]
+    key = response_cache_key("gpt-4o-mini", 1000, messages)
+    assert key != response_cache_key("gpt-4o", 1000, messages)
+    assert key != response_cache_key("gpt-4o-mini", 2000, messages)
@@ -0,0 +1,70 @@
+import asyncio
+
+from . import usage_module, UsageAggregator
+
+
+class FakeDatabase:
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.batches = []
+        self.recorded = []
+
+    async def apply_usage_batch(self, rows):
+        if self.fail:
+            return None  # handle_db_errors при ошибке возвращает None
+        self.batches.append(sorted(row[:4] for row in rows))
+        return True
+
+    async def record_usage(self, telegram_id, **kwargs):
+        self.recorded.append((telegram_id, kwargs))
+        return "state"
+
+
+def test_failed_batch_is_kept_pending(monkeypatch):
+    monkeypatch.setattr(usage_module, "USAGE_FLUSH_INTERVAL", 60)
+    db = FakeDatabase(fail=True)
+
+    async def scenario():
+        usage = UsageAggregator(db)
+        usage.add(1, requests=1, input_tokens=10)
+        await usage.flush()
+        usage.add(1, requests=2, output_tokens=5)
+        assert usage.pending_requests(1) == 3
+        db.fail = False
+        await usage.flush()
+        return usage
+
+    usage = asyncio.run(scenario())
+    assert db.batches == [[(1, 3, 10, 5)]]
+    assert usage.pending == {} and usage.flushing == {}
+
+
+def test_close_flushes_the_rest(monkeypatch):
+    monkeypatch.setattr(usage_module, "USAGE_FLUSH_INTERVAL", 60)
+    db = FakeDatabase()
+
+    async def scenario():
+        usage = await UsageAggregator.create(db)
+        usage.add(1, requests=1)
+        usage.add(2, input_tokens=7)
+        await usage.close()
+        assert usage.flush_task.done()
+
+    asyncio.run(scenario())
+    assert db.batches == [[(1, 1, 0, 0), (2, 0, 7, 0)]]
+
+
+def test_zero_interval_writes_through(monkeypatch):
+    monkeypatch.setattr(usage_module, "USAGE_FLUSH_INTERVAL", 0)
+    db = FakeDatabase()
+
+    async def scenario():
+        usage = await UsageAggregator.create(db)
+        state = await usage.record(1, requests=1, input_tokens=3)
+        await usage.close()
+        return usage, state
+
+    usage, state = asyncio.run(scenario())
+    assert state == "state"
+    assert db.recorded == [(1, {"requests": 1, "input_tokens": 3, "output_tokens": 0})]
+    assert usage.flush_task is None and db.batches == []